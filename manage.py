@@ -2,6 +2,8 @@
 
 
 import os
+import subprocess
+import sys
 import unittest
 import coverage
 
@@ -65,6 +67,16 @@ def cov():
     return 1
 
 
+@manager.option('-m', '--module', dest='module', default='statistic.server.runner', help='module to import')
+@manager.option('-n', '--repeat', dest='repeat', default=5, type=int, help='number of fresh interpreters')
+def bench_import(module='statistic.server.runner', repeat=5):
+    """Measures the import time of a module in fresh interpreters."""
+    code = 'import time; t = time.perf_counter(); import %s; print(time.perf_counter() - t)' % module
+    timings = sorted(float(subprocess.check_output([sys.executable, '-c', code])) for _ in range(repeat))
+    print('import %s: min %.3fs, median %.3fs, max %.3fs' % (
+        module, timings[0], timings[len(timings) // 2], timings[-1]))
+
+
 @manager.command
 def create_db():
     """Creates the db tables."""
@@ -91,6 +103,26 @@ def create_user():
     db.session.commit()
 
 
+@manager.option('-s', '--start', dest='start', default=None, help='first day, YYYY-MM-DD')
+@manager.option('-e', '--end', dest='end', default=None, help='last day, YYYY-MM-DD')
+def rollup(start=None, end=None):
+    """Rebuilds the weekly/monthly/yearly channel statistic rollups."""
+    from statistic.server import util
+    from statistic.server.logic import rollup as channel_rollup
+    n = channel_rollup.rebuild(start_date=start and util.parse_date(start),
+                               end_date=end and util.parse_date(end))
+    db.session.commit()
+    print('%s buckets refreshed' % n)
+
+
+@manager.option('-f', '--file', dest='path', required=True, help='JSON lines file of registration events')
+def ingest_spool(path):
+    """Adds the registration events of a spool file to the channel statistics."""
+    from statistic.server.logic import ingest
+    accepted, rejected = ingest.ingest_spool(path)
+    print('%s events counted, %s rejected' % (accepted, rejected))
+
+
 @manager.command
 def create_data():
     """Creates sample data."""
@@ -0,0 +1,44 @@
+"""indexes for the admin list filters, searches and keyset pagination
+
+Revision ID: 3f2a9c1d7b10
+Revises: None
+Create Date: 2026-10-17 15:02:11.480213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b10'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+UPGRADE_SQL = [
+    'CREATE INDEX IF NOT EXISTS ix_channel_statistic_channel_name_date '
+    'ON channel_statistic (channel_name, date)',
+    'CREATE INDEX IF NOT EXISTS ix_channel_statistic_date_id '
+    'ON channel_statistic (date, id)',
+    'CREATE INDEX IF NOT EXISTS ix_channel_statistic_channel_name_trgm '
+    'ON channel_statistic USING gin (channel_name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_users_email_trgm '
+    'ON users USING gin (email gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_users_channel_name_trgm '
+    'ON users USING gin (channel_name gin_trgm_ops)',
+]
+
+
+def upgrade():
+    # IF NOT EXISTS: databases built by `manage.py create_db` already carry
+    # these from the model metadata
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for sql in UPGRADE_SQL:
+        op.execute(sql)
+
+
+def downgrade():
+    op.drop_index('ix_users_channel_name_trgm', table_name='users')
+    op.drop_index('ix_users_email_trgm', table_name='users')
+    op.drop_index('ix_channel_statistic_channel_name_trgm', table_name='channel_statistic')
+    op.drop_index('ix_channel_statistic_date_id', table_name='channel_statistic')
+    op.drop_index('ix_channel_statistic_channel_name_date', table_name='channel_statistic')
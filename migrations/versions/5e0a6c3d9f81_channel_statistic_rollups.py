@@ -0,0 +1,51 @@
+"""channel_statistic_week/month/year rollup tables
+
+Revision ID: 5e0a6c3d9f81
+Revises: b7d93f2c61e4
+Create Date: 2026-10-18 10:21:44.230917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e0a6c3d9f81'
+down_revision = 'b7d93f2c61e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = ['channel_statistic_week', 'channel_statistic_month', 'channel_statistic_year']
+
+
+def upgrade():
+    bind = op.get_bind()
+    for table in TABLES:
+        # databases built by `manage.py create_db` already have them
+        if bind.dialect.has_table(bind, table):
+            continue
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('created_on', sa.DateTime(timezone=True), nullable=False),
+            sa.Column('updated_on', sa.DateTime(timezone=True), nullable=False),
+            sa.Column('channel_name', sa.String(), nullable=False),
+            sa.Column('period_start', sa.Date(), nullable=False),
+            sa.Column('registered_num', sa.Integer(), nullable=False),
+            sa.Column('activated_num', sa.Float(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('period_start', 'channel_name')
+        )
+
+    # fill them from the daily rows already there
+    for table, unit in zip(TABLES, ['week', 'month', 'year']):
+        op.execute(
+            "INSERT INTO {table} (created_on, updated_on, channel_name, period_start, registered_num, activated_num) "
+            "SELECT now(), now(), channel_name, date_trunc('{unit}', date)::date, "
+            "sum(registered_num), sum(registered_num * factor) "
+            "FROM channel_statistic GROUP BY 3, 4 "
+            "ON CONFLICT (period_start, channel_name) DO NOTHING".format(table=table, unit=unit))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.drop_table(table)
@@ -0,0 +1,25 @@
+"""cover updated_on in the channel/date index of channel_statistic
+
+Revision ID: 8c41e07b5d2a
+Revises: 3f2a9c1d7b10
+Create Date: 2026-10-17 16:40:52.118604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c41e07b5d2a'
+down_revision = '3f2a9c1d7b10'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE INDEX IF NOT EXISTS ix_channel_statistic_channel_name_date_updated '
+               'ON channel_statistic (channel_name, date, updated_on)')
+    op.execute('DROP INDEX IF EXISTS ix_channel_statistic_channel_name_date')
+
+
+def downgrade():
+    op.create_index('ix_channel_statistic_channel_name_date', 'channel_statistic', ['channel_name', 'date'])
+    op.drop_index('ix_channel_statistic_channel_name_date_updated', table_name='channel_statistic')
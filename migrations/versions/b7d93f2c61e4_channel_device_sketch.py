@@ -0,0 +1,32 @@
+"""channel_device_sketch: daily HyperLogLog of the devices per channel
+
+Revision ID: b7d93f2c61e4
+Revises: 8c41e07b5d2a
+Create Date: 2026-10-17 18:12:37.904511
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d93f2c61e4'
+down_revision = '8c41e07b5d2a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'channel_device_sketch',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_on', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('updated_on', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('channel_name', sa.String(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('sketch', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('date', 'channel_name')
+    )
+
+
+def downgrade():
+    op.drop_table('channel_device_sketch')
@@ -6,7 +6,7 @@ from flask.ext import login
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.model import typefmt
 from jinja2 import Markup
-from flask import abort
+from flask import abort, g, request
 
 from statistic.server.models import ChannelStatistic, User
 from statistic.server.models import db
@@ -53,12 +53,15 @@ class BaseModelMixin(object):
                                                                                        model=model.__class__,
                                                                                        value=vars(model))
         logger.info(info)
+        # also dropped again once the change is committed
+        model.invalidate_cache()
 
     def on_model_delete(self, model):
         info = 'user {user} try to delete model {model}, old value are {value}'.format(user=login.current_user.id,
                                                                                        model=model.__class__,
                                                                                        value=vars(model))
         logger.info(info)
+        model.invalidate_cache()
 
 
 class ChannelStatisticView(AdminAccessMixin, BaseModelMixin, ModelView):
@@ -82,6 +85,51 @@ class ChannelStatisticView(AdminAccessMixin, BaseModelMixin, ModelView):
 
     column_editable_list = ('factor',)
 
+    # deep pages use keyset pagination on (date, id) and an estimated count,
+    # see get_list; the pager links carry the cursors
+    list_template = 'admin/channel_list.html'
+    simple_list_pager = True
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        count, query = super(ChannelStatisticView, self).get_list(
+            page, sort_column, sort_desc, search, filters, execute=False, page_size=page_size)
+
+        cursor, before = request.args.get('cursor'), request.args.get('before')
+        if not execute or sort_column not in (None, 'date') or (page and not (cursor or before)):
+            # other orders, and page numbers typed by hand, keep offset paging
+            return count, query.all() if execute else query
+
+        query = query.limit(None).offset(None).order_by(None)
+        descending = sort_desc if sort_column else True
+        num = page_size or self.page_size
+        try:
+            if before:
+                # previous page: walk backwards from its successor's first row
+                items, _ = ChannelStatistic.list('date', num, dir='asc' if descending else 'desc',
+                                                 cursor=before, query=query)
+                items.reverse()
+                next_cursor = ChannelStatistic.encode_cursor('date', items[-1]) if items else None
+            else:
+                items, next_cursor = ChannelStatistic.list('date', num, dir='desc' if descending else 'asc',
+                                                           cursor=cursor, query=query)
+        except ValueError:
+            abort(400)
+
+        prev_cursor = ChannelStatistic.encode_cursor('date', items[0]) if items and page else None
+        g.keyset_cursors = (prev_cursor, next_cursor)
+        return ChannelStatistic.estimate_count(query), items
+
+    def keyset_url(self, page, cursor=None, before=None):
+        args = request.args.to_dict()
+        args.pop('cursor', None)
+        args.pop('before', None)
+        args['page'] = page
+        if cursor:
+            args['cursor'] = cursor
+        if before:
+            args['before'] = before
+        return self.get_url('.index_view', **args)
+
 
 class UsersView(AdminAccessMixin, BaseModelMixin, ModelView):
     can_delete = False
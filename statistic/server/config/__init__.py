@@ -13,6 +13,16 @@ class BaseConfig(object):
     DEBUG_TB_ENABLED = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    OBJECT_CACHE_SIZE = 10000
+    OBJECT_CACHE_TTL = 300
+    # read replicas of SQLALCHEMY_DATABASE_URI, see statistic.server.routing
+    SQLALCHEMY_REPLICA_URIS = []
+    SQLALCHEMY_REPLICA_MAX_LAG = 30
+    SQLALCHEMY_REPLICA_CHECK_INTERVAL = 10
+    # seconds registration events are counted before written, and the
+    # X-Ingest-Token of POST /ingest/registrations (disabled when None)
+    INGEST_WINDOW = 5
+    INGEST_TOKEN = None
 
 
 class DevelopmentConfig(BaseConfig):
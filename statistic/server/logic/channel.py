@@ -0,0 +1,208 @@
+# statistic/server/logic/channel.py
+
+
+from datetime import timedelta
+
+from sqlalchemy import func
+
+from statistic.server.logic import rollup
+from statistic.server.models import db, ChannelStatistic, ChannelDeviceSketch
+from statistic.server.util.hll import HyperLogLog
+
+
+GRANULARITIES = ('day', 'week', 'month')
+
+ONE_DAY = timedelta(days=1)
+
+# registered_num * factor is fractional for factors below 1
+ACTIVATED_DIGITS = 2
+
+
+def visible_channel(user, channel_name=None):
+    '''Channel whose statistics `user` may read: admins pick any channel,
+    everybody else only sees their own.'''
+    if user.is_admin:
+        return channel_name or user.channel_name
+    return user.channel_name
+
+
+def visible_date_range(user, start_date=None, end_date=None):
+    '''Clip [start_date, end_date] to the show_date_*_limit of `user`.
+    Returns None when nothing of the range is visible.'''
+    if not user.is_admin:
+        start_date = max(start_date or user.show_date_begin_limit, user.show_date_begin_limit)
+        end_date = min(end_date or user.show_date_end_limit, user.show_date_end_limit)
+
+    if start_date and end_date and start_date > end_date:
+        return None
+    return start_date, end_date
+
+
+def activated_value(value):
+    '''activated_num as both the CSV download and the series serve it.'''
+    return round(float(value), ACTIVATED_DIGITS)
+
+
+def daily_statistics(channel_name, start_date=None, end_date=None):
+    '''Query of (date, channel_name, activated_num) rows, oldest first.'''
+    query = db.session.query(
+        ChannelStatistic.date,
+        ChannelStatistic.channel_name,
+        (ChannelStatistic.registered_num * ChannelStatistic.factor).label('activated_num'),
+    ).filter(ChannelStatistic.channel_name == channel_name)
+
+    if start_date:
+        query = query.filter(ChannelStatistic.date >= start_date)
+    if end_date:
+        query = query.filter(ChannelStatistic.date <= end_date)
+
+    return query.order_by(ChannelStatistic.date)
+
+
+def _version_of(model, channel_name, start_date, end_date):
+    query = db.session.query(func.count(), func.max(model.updated_on)) \
+        .filter(model.channel_name == channel_name)
+
+    if start_date:
+        query = query.filter(model.date >= start_date)
+    if end_date:
+        query = query.filter(model.date <= end_date)
+
+    return tuple(query.one())
+
+
+def slice_version(channel_name, start_date=None, end_date=None):
+    '''(row count, latest updated_on) of the daily rows of `channel_name` in
+    the range, which changes with every insert, update or delete of them.'''
+    return _version_of(ChannelStatistic, channel_name, start_date, end_date)
+
+
+def device_slice_version(channel_name, start_date=None, end_date=None):
+    '''slice_version of the daily device sketches of `channel_name`.'''
+    return _version_of(ChannelDeviceSketch, channel_name, start_date, end_date)
+
+
+def split_range(start_date, end_date, bucket):
+    '''Split [start_date, end_date] into the half-open span of whole buckets,
+    (None, None) when there is none, and the partial ranges at its edges.'''
+    stop = end_date + ONE_DAY if end_date else None
+    full_start, full_stop = start_date, stop
+    if start_date and bucket(start_date)[0] != start_date:
+        full_start = bucket(start_date)[1]
+    if end_date and bucket(end_date)[1] != stop:
+        full_stop = bucket(end_date)[0]
+
+    if full_start and full_stop and full_start > full_stop:
+        # the range sits inside a single bucket
+        return (None, None), [(start_date, stop)]
+
+    partial = []
+    if start_date and full_start != start_date:
+        partial.append((start_date, full_start))
+    if end_date and full_stop != stop:
+        partial.append((full_stop, stop))
+    if full_start and full_start == full_stop:
+        # the tail of one bucket and the head of the next, nothing whole
+        return (None, None), partial
+    return (full_start, full_stop), partial
+
+
+def _activated_sum(channel_name, start, stop):
+    return db.session.query(func.sum(ChannelStatistic.registered_num * ChannelStatistic.factor)) \
+        .filter(ChannelStatistic.channel_name == channel_name,
+                ChannelStatistic.date >= start,
+                ChannelStatistic.date < stop) \
+        .scalar()
+
+
+def _bucket_series(channel_name, start_date, end_date, granularity):
+    # whole buckets come from the rollup table; the clipped ones at the
+    # edges are summed from the daily rows of the visible days only
+    model, bucket = rollup.ROLLUPS[granularity]
+    (full_start, full_stop), partial = split_range(start_date, end_date, bucket)
+
+    series = []
+    if full_start is not None or full_stop is not None or not partial:
+        query = db.session.query(model.period_start, model.activated_num) \
+            .filter(model.channel_name == channel_name)
+        if full_start:
+            query = query.filter(model.period_start >= full_start)
+        if full_stop:
+            query = query.filter(model.period_start < full_stop)
+        series.extend(query)
+
+    for start, stop in partial:
+        value = _activated_sum(channel_name, start, stop)
+        if value is not None:
+            series.append((bucket(start)[0], value))
+
+    return sorted(series)
+
+
+def activated_series(channel_name, start_date=None, end_date=None, granularity='day', version=None):
+    '''[(period_start, activated_num)] of `channel_name` per day, week or
+    month, oldest first. Cached under the slice_version of the range, which
+    callers that already have it pass as `version`, so every process drops
+    it as soon as the daily rows change.'''
+    if granularity not in GRANULARITIES:
+        raise ValueError('unknown granularity %r' % granularity)
+
+    # read the version before the rows, so whatever gets cached under it is
+    # at least as new as it
+    if version is None:
+        version = slice_version(channel_name, start_date, end_date)
+    count, last_modified = version
+    key = 'channelstatistic:series:%s:%s:%s:%s:%s:%s' % (
+        channel_name, start_date, end_date, granularity, count,
+        last_modified.isoformat() if last_modified else None)
+    backend = ChannelStatistic.cache_backend()
+    series = backend.get(key)
+    if series is None:
+        if granularity == 'day':
+            series = [(row.date, row.activated_num)
+                      for row in daily_statistics(channel_name, start_date, end_date)]
+        else:
+            series = _bucket_series(channel_name, start_date, end_date, granularity)
+        series = [(period_start, activated_value(value)) for period_start, value in series]
+        backend.set(key, series)
+    return series
+
+
+def unique_device_series(channel_name, start_date=None, end_date=None, granularity='day', version=None):
+    '''([(period_start, unique devices)], unique devices of the whole range)
+    of `channel_name`, from the unions of its daily device sketches. Cached
+    under the device_slice_version of the range, like activated_series.'''
+    if granularity not in GRANULARITIES:
+        raise ValueError('unknown granularity %r' % granularity)
+
+    if version is None:
+        version = device_slice_version(channel_name, start_date, end_date)
+    count, last_modified = version
+    key = 'channeldevicesketch:series:%s:%s:%s:%s:%s:%s' % (
+        channel_name, start_date, end_date, granularity, count,
+        last_modified.isoformat() if last_modified else None)
+    backend = ChannelDeviceSketch.cache_backend()
+    result = backend.get(key)
+    if result is None:
+        result = _unique_device_series(channel_name, start_date, end_date, granularity)
+        backend.set(key, result)
+    return result
+
+
+def _unique_device_series(channel_name, start_date, end_date, granularity):
+    query = db.session.query(ChannelDeviceSketch.date, ChannelDeviceSketch.sketch) \
+        .filter(ChannelDeviceSketch.channel_name == channel_name)
+    if start_date:
+        query = query.filter(ChannelDeviceSketch.date >= start_date)
+    if end_date:
+        query = query.filter(ChannelDeviceSketch.date <= end_date)
+
+    periods = {}
+    for day, sketch in query:
+        period_start = day if granularity == 'day' else rollup.ROLLUPS[granularity][1](day)[0]
+        periods.setdefault(period_start, []).append(HyperLogLog.from_bytes(sketch))
+
+    series = [(period_start, HyperLogLog.union(periods[period_start]))
+              for period_start in sorted(periods)]
+    total = HyperLogLog.union(sketch for _, sketch in series)
+    return [(period_start, sketch.count()) for period_start, sketch in series], total.count()
@@ -0,0 +1,253 @@
+# statistic/server/logic/ingest.py
+
+
+import atexit
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+from statistic.server import util
+from statistic.server.models import db, ChannelStatistic, ChannelDeviceSketch
+from statistic.server.util.hll import HyperLogLog
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# counts given up on, one registration event per line, which ingest_spool
+# can replay once the cause is fixed
+dead_letter_logger = logging.getLogger(__name__ + '.dead_letter')
+
+# events read from a spool file per add()
+SPOOL_CHUNK_SIZE = 10000
+
+# largest `count` of one event, and of the pending delta of one key, which
+# has to fit the int4 registered_num column
+MAX_EVENT_COUNT = 10000
+MAX_PENDING_COUNT = 2 ** 31 - 1
+
+# failed flushes a key is put back for before it is dead-lettered
+FLUSH_MAX_ATTEMPTS = 3
+
+
+def parse_event(event):
+    '''
+    (date, channel_name, count) of a registration event, a dict with
+    `channel_name`, `ts` (the time of registration) and an optional integer
+    `count` of at most MAX_EVENT_COUNT. The date is the PARTNER_DEFAULT_TZ
+    day of `ts`. Raises ValueError.
+    '''
+    try:
+        channel_name = event['channel_name']
+        day = util.start_of_day(util.parse_datetime(event['ts'])).date()
+        count = event.get('count', 1)
+    except (KeyError, TypeError, ValueError, AttributeError, OverflowError) as e:
+        raise ValueError('bad registration event %r: %r' % (event, e))
+    if not channel_name or not isinstance(channel_name, str):
+        raise ValueError('bad registration event %r' % (event,))
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= MAX_EVENT_COUNT:
+        raise ValueError('bad registration event %r: count must be an integer from 1 to %d' % (
+            event, MAX_EVENT_COUNT))
+    return day, channel_name, count
+
+
+class RegistrationAggregator(object):
+    '''
+    Counts registration events per (date, channel_name) in memory and adds
+    the counts to ChannelStatistic.registered_num, one atomic increment per
+    key, every `window` seconds from a background thread. The `device_id`s
+    of the events go into the ChannelDeviceSketch of the key.
+
+    A key whose write failed FLUSH_MAX_ATTEMPTS times is dropped and its
+    count logged to the dead letter logger, so it cannot fail every later
+    window too. Counts still pending when the process dies are lost; use
+    flush() at shutdown.
+    '''
+
+    def __init__(self, app=None, window=5.):
+        self.app = app
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._pending = collections.Counter()
+        self._sketches = {}
+        self._attempts = collections.Counter()
+
+    def init_app(self, app):
+        self.app = app
+        self.window = app.config.get('INGEST_WINDOW', self.window)
+
+    def _ensure_worker(self):
+        # threads do not survive a fork, every uwsgi worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # inherited from the parent, which writes them itself
+                self._pending = collections.Counter()
+                self._sketches = {}
+                self._attempts = collections.Counter()
+            thread = threading.Thread(target=self._run, name='registration-aggregator')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def add(self, events, background=True, default_device_id=None):
+        '''Count `events`; returns the number of (accepted, rejected) ones.'''
+        counts = collections.Counter()
+        sketches = {}
+        accepted = rejected = 0
+        for event in events:
+            try:
+                day, channel_name, count = parse_event(event)
+            except ValueError as e:
+                logger.warning('%s', e)
+                rejected += 1
+                continue
+            counts[(day, channel_name)] += count
+            accepted += 1
+
+            device_id = event.get('device_id') or default_device_id
+            if device_id:
+                sketch = sketches.get((day, channel_name))
+                if sketch is None:
+                    sketch = sketches[(day, channel_name)] = HyperLogLog()
+                sketch.add(device_id)
+
+        if background:
+            self._ensure_worker()
+        with self._lock:
+            for key, count in counts.items():
+                if self._pending[key] + count > MAX_PENDING_COUNT:
+                    self._dead_letter({key: count}, 'pending count out of range')
+                else:
+                    self._pending[key] += count
+            self._merge_sketches(sketches)
+        return accepted, rejected
+
+    def _merge_sketches(self, sketches):
+        for key, sketch in sketches.items():
+            if key in self._sketches:
+                self._sketches[key].merge(sketch)
+            else:
+                self._sketches[key] = sketch
+
+    def pending(self):
+        with self._lock:
+            return len(set(self._pending) | set(self._sketches))
+
+    def flush(self):
+        '''
+        Write the pending counts in one transaction; returns the number of
+        keys written. Needs an app context. On failure the counts are put
+        back for the next flush, up to FLUSH_MAX_ATTEMPTS times per key.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                counts, self._pending = self._pending, collections.Counter()
+                sketches, self._sketches = self._sketches, {}
+            if not counts and not sketches:
+                return 0
+
+            rows = [dict(date=day, channel_name=channel_name, registered_num=count)
+                    for (day, channel_name), count in sorted(counts.items())]
+            keys = set(counts) | set(sketches)
+            try:
+                if rows:
+                    ChannelStatistic.bulk_upsert(rows, increment_columns=['registered_num'])
+                ChannelDeviceSketch.merge_sketches(sketches)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self._put_back(keys, counts, sketches, e)
+                raise
+            with self._lock:
+                for key in keys:
+                    self._attempts.pop(key, None)
+            return len(keys)
+
+    def _put_back(self, keys, counts, sketches, error):
+        with self._lock:
+            for key in keys:
+                self._attempts[key] += 1
+            given_up = set(key for key in keys if self._attempts[key] >= FLUSH_MAX_ATTEMPTS)
+            for key in given_up:
+                del self._attempts[key]
+            self._dead_letter(dict((key, counts[key]) for key in given_up if key in counts), error)
+            self._pending.update(dict((key, count) for key, count in counts.items() if key not in given_up))
+            self._merge_sketches(dict((key, sketch) for key, sketch in sketches.items() if key not in given_up))
+
+    def _dead_letter(self, counts, reason):
+        for (day, channel_name), count in sorted(counts.items()):
+            logger.error('dropping %s registrations of %s on %s: %s', count, channel_name, day, reason)
+            # in events ingest_spool accepts again
+            while count > 0:
+                dead_letter_logger.error(json.dumps(dict(channel_name=channel_name, ts=util.unparse_date(day),
+                                                         count=min(count, MAX_EVENT_COUNT))))
+                count -= MAX_EVENT_COUNT
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                with self.app.app_context():
+                    n = self.flush()
+                if n:
+                    logger.debug('flushed %s registration counters', n)
+            except Exception as e:
+                logger.exception(e)
+
+
+registrations = RegistrationAggregator()
+
+
+def _flush_at_exit():
+    if not registrations.pending():
+        return
+    try:
+        with registrations.app.app_context():
+            registrations.flush()
+    except Exception as e:
+        logger.exception(e)
+
+
+def init_ingest(app):
+    registrations.init_app(app)
+    atexit.register(_flush_at_exit)
+
+
+def ingest_spool(path, aggregator=None):
+    '''
+    Count the registration events in the JSON lines file `path` and write
+    them at once. The file is renamed to <path>.done afterwards, so running
+    it again does not count it twice. Returns (accepted, rejected).
+    '''
+    aggregator = aggregator or RegistrationAggregator()
+    accepted = rejected = 0
+    with open(path) as f:
+        lines = (line for line in f if line.strip())
+        while True:
+            lines_chunk = list(itertools.islice(lines, SPOOL_CHUNK_SIZE))
+            if not lines_chunk:
+                break
+            chunk = []
+            for line in lines_chunk:
+                try:
+                    chunk.append(json.loads(line))
+                except ValueError:
+                    logger.warning('bad spool line %r', line)
+                    rejected += 1
+            n_accepted, n_rejected = aggregator.add(chunk, background=False)
+            accepted += n_accepted
+            rejected += n_rejected
+
+    aggregator.flush()
+    os.rename(path, path + '.done')
+    return accepted, rejected
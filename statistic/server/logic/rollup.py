@@ -0,0 +1,135 @@
+# statistic/server/logic/rollup.py
+
+
+import itertools
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, inspect, text
+from flask.ext.sqlalchemy import SignallingSession
+
+from statistic.server import util
+from statistic.server.models import db, ChannelStatistic, ChannelStatisticWeekly, \
+    ChannelStatisticMonthly, ChannelStatisticYearly, ROLLUP_DIRTY_KEY
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = ROLLUP_DIRTY_KEY
+
+
+def _as_datetime(day):
+    return datetime.combine(day, time())
+
+
+def week_bucket(day):
+    start = util.start_of_week(_as_datetime(day))
+    return start.date(), (start + timedelta(days=7)).date()
+
+
+def month_bucket(day):
+    start = util.start_of_month(_as_datetime(day))
+    return start.date(), util.start_of_month(start + timedelta(days=32)).date()
+
+
+def year_bucket(day):
+    start = util.start_of_year(_as_datetime(day))
+    return start.date(), start.replace(year=start.year + 1).date()
+
+
+ROLLUPS = {
+    'week': (ChannelStatisticWeekly, week_bucket),
+    'month': (ChannelStatisticMonthly, month_bucket),
+    'year': (ChannelStatisticYearly, year_bucket),
+}
+
+UPSERT_SQL = '''
+INSERT INTO {table} (created_on, updated_on, channel_name, period_start, registered_num, activated_num)
+SELECT :now, :now, :channel_name, :start, sum(registered_num), sum(registered_num * factor)
+FROM channel_statistic
+WHERE channel_name = :channel_name AND date >= :start AND date < :end
+HAVING count(*) > 0
+ON CONFLICT (period_start, channel_name) DO UPDATE
+SET registered_num = EXCLUDED.registered_num,
+    activated_num = EXCLUDED.activated_num,
+    updated_on = EXCLUDED.updated_on
+'''
+
+DELETE_EMPTY_SQL = '''
+DELETE FROM {table}
+WHERE channel_name = :channel_name AND period_start = :start AND NOT EXISTS (
+    SELECT 1 FROM channel_statistic
+    WHERE channel_name = :channel_name AND date >= :start AND date < :end
+)
+'''
+
+
+def refresh_buckets(keys, session=None):
+    '''Recompute the week/month/year rows covering each (date, channel_name)
+    in `keys` from the daily rows; buckets shared by several keys are only
+    computed once.'''
+    session = session or db.session
+    buckets = set()
+    for day, channel_name in keys:
+        for model, bucket in ROLLUPS.values():
+            buckets.add((model.__tablename__, channel_name) + bucket(day))
+
+    now = util.now()
+    for table, channel_name, start, end in sorted(buckets):
+        params = dict(now=now, channel_name=channel_name, start=start, end=end)
+        session.execute(text(UPSERT_SQL.format(table=table)), params)
+        session.execute(text(DELETE_EMPTY_SQL.format(table=table)), params)
+
+    return len(buckets)
+
+
+def rebuild(start_date=None, end_date=None, session=None):
+    '''Recompute every bucket touched by daily rows between the given dates.'''
+    session = session or db.session
+    query = session.query(ChannelStatistic.date, ChannelStatistic.channel_name).distinct()
+    if start_date:
+        query = query.filter(ChannelStatistic.date >= start_date)
+    if end_date:
+        query = query.filter(ChannelStatistic.date <= end_date)
+    return refresh_buckets(query, session=session)
+
+
+def mark_dirty(session, keys):
+    '''Schedule a bucket refresh at commit for changes the ORM did not see,
+    e.g. bulk statements.'''
+    session.info.setdefault(DIRTY_KEY, set()).update(keys)
+
+
+def _changed_keys(obj):
+    state = inspect(obj)
+    days = set([obj.date]) | set(state.attrs.date.history.deleted)
+    channels = set([obj.channel_name]) | set(state.attrs.channel_name.history.deleted)
+    return itertools.product(days, channels)
+
+
+def _collect_changes(session, flush_context):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, ChannelStatistic):
+            mark_dirty(session, _changed_keys(obj))
+
+
+def _refresh_before_commit(session):
+    # commit flushes right after this hook anyway; flush first so every
+    # pending change has been collected
+    session.flush()
+    keys = session.info.pop(DIRTY_KEY, None)
+    if keys:
+        n = refresh_buckets(keys, session=session)
+        logger.debug('refreshed %s channel statistic rollup buckets', n)
+
+
+def _discard_changes(session):
+    session.info.pop(DIRTY_KEY, None)
+
+
+def init_rollup():
+    for name, fn in (('after_flush', _collect_changes),
+                     ('before_commit', _refresh_before_commit),
+                     ('after_rollback', _discard_changes)):
+        if not event.contains(SignallingSession, name, fn):
+            event.listen(SignallingSession, name, fn)
@@ -5,8 +5,19 @@
 #### imports ####
 #################
 
-from flask import render_template, Blueprint
-from flask.ext.login import login_required
+import hashlib
+import hmac
+
+import pytz
+from flask import render_template, Blueprint, Response, abort, request, \
+    stream_with_context, jsonify, current_app
+from flask.ext.login import login_required, current_user
+from werkzeug.http import is_resource_modified
+
+from statistic.server import util
+from statistic.server.logic import channel as channel_logic
+from statistic.server.logic import ingest
+from statistic.server.util.stat import iterCSV
 
 ################
 #### config ####
@@ -14,6 +25,59 @@ from flask.ext.login import login_required
 
 main_blueprint = Blueprint('main', __name__,)
 
+# rows fetched per round trip while streaming a download
+DOWNLOAD_FETCH_SIZE = 1000
+
+
+################
+#### helpers ####
+################
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return util.parse_date(value)
+    except (ValueError, OverflowError):
+        abort(400)
+
+
+def _slice_version(channel_name, date_range, version_of=channel_logic.slice_version):
+    if date_range is None:
+        return 0, None
+    return version_of(channel_name, *date_range)
+
+
+def _validators(channel_name, date_range, version, *variant):
+    '''(etag, last_modified) of the rows of `channel_name` in `date_range`
+    at `version`, see logic.channel.slice_version; `variant` tells apart the
+    representations of the same slice.'''
+    count, last_modified = version
+    key = repr((channel_name, date_range, variant, count, last_modified))
+    etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    if last_modified is not None:
+        # werkzeug compares against naive utc, http dates drop the microseconds
+        last_modified = util.to_aware_datetime(last_modified, pytz.utc).replace(tzinfo=None, microsecond=0)
+    return etag, last_modified
+
+
+def _conditional(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # always revalidate, and never hand one user's figures to another
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def _not_modified(etag, last_modified):
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return _conditional(Response(status=304), etag, last_modified)
+
 
 ################
 #### routes ####
@@ -24,3 +88,123 @@ main_blueprint = Blueprint('main', __name__,)
 @login_required
 def home():
     return render_template('main/home.html')
+
+
+@main_blueprint.route('/channel/statistics.csv')
+@login_required
+def channel_statistics_csv():
+    channel_name = channel_logic.visible_channel(current_user, request.args.get('channel_name'))
+    if not channel_name:
+        abort(403)
+
+    date_range = channel_logic.visible_date_range(
+        current_user, _date_arg('start_date'), _date_arg('end_date'))
+
+    # answer revalidations before anything gets streamed
+    etag, last_modified = _validators(channel_name, date_range, _slice_version(channel_name, date_range), 'csv')
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    def generate():
+        rows = []
+        if date_range is not None:
+            query = channel_logic.daily_statistics(channel_name, *date_range)
+            rows = (dict(date=util.unparse_date(row.date),
+                         channel_name=row.channel_name,
+                         activated_num=channel_logic.activated_value(row.activated_num))
+                    for row in query.yield_per(DOWNLOAD_FETCH_SIZE))
+        for chunk in iterCSV(rows, ['date', 'channel_name', 'activated_num'], batch_size=DOWNLOAD_FETCH_SIZE):
+            yield chunk.encode('utf-8')
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=channel_statistic.csv'
+    return _conditional(response, etag, last_modified)
+
+
+@main_blueprint.route('/channel/series.json')
+@login_required
+def channel_series():
+    channel_name = channel_logic.visible_channel(current_user, request.args.get('channel_name'))
+    if not channel_name:
+        abort(403)
+
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in channel_logic.GRANULARITIES:
+        abort(400)
+
+    date_range = channel_logic.visible_date_range(
+        current_user, _date_arg('start_date'), _date_arg('end_date'))
+
+    # the body is cached under the same version, so it always matches the validators
+    version = _slice_version(channel_name, date_range)
+    etag, last_modified = _validators(channel_name, date_range, version, 'series', granularity)
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    series = []
+    if date_range is not None:
+        start_date, end_date = date_range
+        series = channel_logic.activated_series(channel_name, start_date, end_date, granularity, version=version)
+
+    response = jsonify(channel_name=channel_name,
+                       granularity=granularity,
+                       series=[dict(date=util.unparse_date(period_start), activated_num=value)
+                               for period_start, value in series])
+    return _conditional(response, etag, last_modified)
+
+
+@main_blueprint.route('/channel/devices.json')
+@login_required
+def channel_devices():
+    channel_name = channel_logic.visible_channel(current_user, request.args.get('channel_name'))
+    if not channel_name:
+        abort(403)
+
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in channel_logic.GRANULARITIES:
+        abort(400)
+
+    date_range = channel_logic.visible_date_range(
+        current_user, _date_arg('start_date'), _date_arg('end_date'))
+
+    version = _slice_version(channel_name, date_range, channel_logic.device_slice_version)
+    etag, last_modified = _validators(channel_name, date_range, version, 'devices', granularity)
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    series, total = [], 0
+    if date_range is not None:
+        start_date, end_date = date_range
+        series, total = channel_logic.unique_device_series(channel_name, start_date, end_date, granularity,
+                                                           version=version)
+
+    response = jsonify(channel_name=channel_name,
+                       granularity=granularity,
+                       unique_devices=total,
+                       series=[dict(date=util.unparse_date(period_start), unique_devices=value)
+                               for period_start, value in series])
+    return _conditional(response, etag, last_modified)
+
+
+@main_blueprint.route('/ingest/registrations', methods=['POST'])
+def ingest_registrations():
+    token = current_app.config.get('INGEST_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Ingest-Token', '').encode('utf-8'), token.encode('utf-8')):
+        abort(403)
+
+    payload = request.get_json(silent=True)
+    events = payload.get('events') if isinstance(payload, dict) else payload
+    if not isinstance(events, list):
+        abort(400)
+
+    # counted now, written by the aggregator within INGEST_WINDOW seconds;
+    # events without a device_id come from the posting device itself
+    accepted, rejected = ingest.registrations.add(events, default_device_id=util.client_identifier(request))
+    response = jsonify(accepted=accepted, rejected=rejected)
+    response.status_code = 202
+    return response
@@ -1,29 +1,79 @@
 # stat/server/models.py
 
 
+import base64
+import collections
 import datetime
+import itertools
+import json
 
 from . import util
-
-from flask.ext.sqlalchemy import SQLAlchemy
+from .util import cache
+from .util.hll import HyperLogLog
+from .routing import RoutingSQLAlchemy, RoutingQuery
+
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from werkzeug.security import generate_password_hash, \
     check_password_hash
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# session.info key of the (date, channel_name) pairs whose rollups need a refresh
+ROLLUP_DIRTY_KEY = 'channel_statistic_rollup_dirty'
+# session.info key of the object cache entries to drop again after commit
+CACHE_INVALIDATION_KEY = 'cache_invalidations'
+
+# range of postgres integer columns, checked before values from the outside reach them
+_INT4_MIN, _INT4_MAX = -2 ** 31, 2 ** 31 - 1
+
+# backend of the CRUDMixin read-through cache, see set_cache_backend
+object_cache = cache.LRUCache(maxsize=10000, ttl=300)
+
+
+# trigram indexes back the admin ILIKE searches
+event.listen(db.metadata, 'before_create',
+             db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
 
 
 def init_model(app):
     db.init_app(app)
+    set_cache_backend(cache.LRUCache(maxsize=app.config.get('OBJECT_CACHE_SIZE', 10000),
+                                     ttl=app.config.get('OBJECT_CACHE_TTL', 300)))
+
+
+def set_cache_backend(backend):
+    '''Swap the object cache, e.g. for a shared RedisCache or a stand-in in tests.'''
+    global object_cache
+    object_cache = backend
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _invalidate_after_commit(session):
+    # a concurrent reader may have cached the old row between the write and the commit
+    for model, key in session.info.pop(CACHE_INVALIDATION_KEY, ()):
+        model.cache_backend().delete(key)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_invalidations(session):
+    session.info.pop(CACHE_INVALIDATION_KEY, None)
 
 
 class CommonColumnMixin(object):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    created_on = db.Column(db.DateTime(timezone=True), nullable=False, default=util.now())
-    updated_on = db.Column(db.DateTime(timezone=True), nullable=False, default=util.now())
+    created_on = db.Column(db.DateTime(timezone=True), nullable=False, default=util.now)
+    updated_on = db.Column(db.DateTime(timezone=True), nullable=False, default=util.now, onupdate=util.now)
 
 
 class CRUDMixin(object):
     USE_CACHE = False
+    # per model cache backend, object_cache when None
+    CACHE = None
+    BULK_BATCH_SIZE = 1000
 
     # basic CRUD
 
@@ -48,36 +98,115 @@ class CRUDMixin(object):
         for k, v in kwargs.items():
             if not getattr(self, k, None) == v:
                 setattr(self, k, v)
+        self.invalidate_cache()
         return self
 
     def delete(self):
         db.session.delete(self)
         db.session.flush([self])
+        self.invalidate_cache()
         return self
 
     # misc
     def save(self):
         db.session.add(self)
         db.session.flush([self])
+        self.invalidate_cache()
         return self
 
     def inc(self, field, n=1):
-        value = getattr(self, field)
-        setattr(self, field, value + n)
+        if not inspect(self).persistent:
+            setattr(self, field, getattr(self, field) + n)
+            return self
+        # flushed right away as SET field = field + n, so concurrent
+        # increments add up; the flush expires the attribute and the next
+        # access loads the stored sum
+        setattr(self, field, getattr(type(self), field) + n)
+        db.session.flush([self])
+        self.invalidate_cache()
         return self
 
     def dec(self, field, n=1):
-        value = getattr(self, field)
-        setattr(self, field, value - n)
-        return self
+        return self.inc(field, -n)
+
+    # cache
 
     @property
     def cache_key(self):
         return '%s:%s' % (type(self).__name__.lower(), self.id)
 
+    @classmethod
+    def cache_backend(cls):
+        return object_cache if cls.CACHE is None else cls.CACHE
+
+    @classmethod
+    def _cache_key_of(cls, oid):
+        return '%s:%s' % (cls.__name__.lower(), oid)
+
+    @classmethod
+    def _lookup_cache_key(cls, kwargs):
+        return '%s:%s' % (cls.__name__.lower(), ','.join('%s=%s' % (k, kwargs[k]) for k in sorted(kwargs)))
+
+    def _cache_values(self):
+        return dict((attr.key, getattr(self, attr.key)) for attr in inspect(type(self)).column_attrs)
+
+    @classmethod
+    def _from_cache_values(cls, values):
+        obj = inspect(cls).class_manager.new_instance()
+        for k, v in values.items():
+            set_committed_value(obj, k, v)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    def invalidate_cache(self):
+        if self.USE_CACHE and self.id is not None:
+            self.cache_backend().delete(self.cache_key)
+            db.session.info.setdefault(CACHE_INVALIDATION_KEY, set()).add((type(self), self.cache_key))
+
+    @classmethod
+    def get(cls, oid):
+        if not cls.USE_CACHE:
+            return cls.query.get(oid)
+
+        # objects already in the session win over the cache
+        obj = db.session.identity_map.get(identity_key(cls, oid))
+        if obj is not None:
+            return obj
+
+        values = cls.cache_backend().get(cls._cache_key_of(oid))
+        if values is not None:
+            return cls._from_cache_values(values)
+
+        # fill from the primary: a lagging replica could still hold the row
+        # as it was before the write that just invalidated it
+        obj = cls.query.set_use_master().get(oid)
+        if obj is not None:
+            cls.cache_backend().set(obj.cache_key, obj._cache_values())
+        return obj
+
     @classmethod
     def get_one(cls, **kwargs):
-        return cls.query.filter_by(**kwargs).first()
+        if not cls.USE_CACHE:
+            return cls.query.filter_by(**kwargs).first()
+
+        if list(kwargs) == ['id']:
+            return cls.get(kwargs['id'])
+
+        # lookups only remember the id; the row itself is checked again
+        # since it may have changed since
+        backend = cls.cache_backend()
+        lookup_key = cls._lookup_cache_key(kwargs)
+        oid = backend.get(lookup_key)
+        if oid is not None:
+            obj = cls.get(oid)
+            if obj is not None and all(getattr(obj, k) == v for k, v in kwargs.items()):
+                return obj
+
+        obj = cls.query.filter_by(**kwargs).set_use_master().first()
+        if obj is not None:
+            backend.set(lookup_key, obj.id)
+            backend.set(obj.cache_key, obj._cache_values())
+        return obj
 
     @classmethod
     def exists(cls, **kwargs):
@@ -108,21 +237,284 @@ class CRUDMixin(object):
         return obj, created
 
     @classmethod
-    def list(cls, order_by, num, dir='desc', cursor=None, limit=None):
-        raise NotImplementedError()
+    def list(cls, order_by, num, dir='desc', cursor=None, limit=None, query=None):
+        '''
+        Keyset pagination over (`order_by`, id): returns up to `num` objects
+        after `cursor` and the cursor of the next page, None on the last page.
+        `limit` is the last value of `order_by` to include; `query` narrows
+        the rows, e.g. to filters of an admin view. Every page costs one
+        index range scan, however deep it is.
+        '''
+        if num < 1:
+            raise ValueError('num must be at least 1, not %r' % num)
+        column = getattr(cls, order_by)
+        descending = dir == 'desc'
+        query = cls.query if query is None else query
+
+        if cursor is not None:
+            value, oid = cls.decode_cursor(order_by, cursor)
+            key = db.tuple_(column, cls.id)
+            query = query.filter(key < db.tuple_(value, oid) if descending else key > db.tuple_(value, oid))
+        if limit is not None:
+            query = query.filter(column >= limit if descending else column <= limit)
+
+        if descending:
+            query = query.order_by(column.desc(), cls.id.desc())
+        else:
+            query = query.order_by(column.asc(), cls.id.asc())
+
+        items = query.limit(num + 1).all()
+        next_cursor = cls.encode_cursor(order_by, items[num - 1]) if len(items) > num else None
+        return items[:num], next_cursor
+
+    @classmethod
+    def encode_cursor(cls, order_by, obj):
+        value = getattr(obj, order_by)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        data = json.dumps([value, obj.id], separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @classmethod
+    def decode_cursor(cls, order_by, cursor):
+        '''(value, id) of an encode_cursor() cursor; cursors come from the
+        query string, anything else raises ValueError.'''
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise ValueError('invalid cursor %r' % cursor)
+        if not isinstance(data, list) or len(data) != 2:
+            raise ValueError('invalid cursor %r' % cursor)
+        value, oid = data
+        if not isinstance(oid, int) or isinstance(oid, bool) or not _INT4_MIN <= oid <= _INT4_MAX:
+            raise ValueError('invalid cursor %r' % cursor)
+
+        python_type = getattr(cls, order_by).property.columns[0].type.python_type
+        try:
+            if python_type in (datetime.datetime, datetime.date):
+                if not isinstance(value, str):
+                    raise ValueError
+                value = util.parse_datetime(value) if python_type is datetime.datetime else util.parse_date(value)
+            elif python_type is float and isinstance(value, int):
+                value = float(value)
+        except (ValueError, OverflowError):
+            raise ValueError('invalid cursor %r' % cursor)
+        if value is not None and (not isinstance(value, python_type) or isinstance(value, bool)):
+            raise ValueError('invalid cursor %r' % cursor)
+        if isinstance(value, int) and not _INT4_MIN <= value <= _INT4_MAX:
+            raise ValueError('invalid cursor %r' % cursor)
+        return value, oid
+
+    @classmethod
+    def estimate_count(cls, query=None):
+        '''The planner's row estimate for `query`, without a COUNT(*) scan.'''
+        query = cls.query if query is None else query
+        statement = query.limit(None).offset(None).order_by(None).statement
+        compiled = statement.compile(dialect=db.engine.dialect)
+        connection = db.session.connection(mapper=inspect(cls), clause=statement)
+        plan = connection.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    # bulk
+
+    @classmethod
+    def bulk_upsert(cls, rows, conflict_columns=None, update_columns=None, batch_size=None,
+                    increment_columns=()):
+        '''
+        Insert `rows` (dicts with the same keys) with INSERT ... ON CONFLICT DO
+        UPDATE, `batch_size` rows per statement. Conflicts are detected on
+        `conflict_columns`, by default the table's first unique constraint;
+        `update_columns` (default: every other given column) are overwritten,
+        except `increment_columns`, which are added to the stored value.
+        Returns the number of rows (inserted, updated).
+        '''
+        table = cls.__table__
+        quote = db.engine.dialect.identifier_preparer.quote
+        conflict_columns = list(conflict_columns or cls._unique_columns())
+        increment_columns = set(increment_columns)
+        batch_size = batch_size or cls.BULK_BATCH_SIZE
+
+        # the statement bypasses the ORM, so fill in the python side defaults
+        defaults = dict((c.name, c.default.arg) for c in table.columns
+                        if c.default is not None and c.default.is_scalar)
+
+        inserted = updated = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+
+            updates = [name for name in (update_columns or batch[0])
+                       if name not in conflict_columns and name not in ('id', 'created_on', 'updated_on')]
+            updates.append('updated_on')
+
+            now = util.now()
+            timestamps = dict(defaults, created_on=now, updated_on=now)
+            # postgres refuses to update the same row twice in one statement;
+            # increments of the same row are summed up instead
+            merged = collections.OrderedDict()
+            for row in batch:
+                key = tuple(row[c] for c in conflict_columns)
+                previous = merged.get(key)
+                merged[key] = dict(timestamps, **row)
+                if previous is not None:
+                    for name in increment_columns:
+                        merged[key][name] += previous[name]
+            batch = list(merged.values())
+            names = [c.name for c in table.columns if c.name in batch[0]]
+
+            values, params = [], {}
+            for i, row in enumerate(batch):
+                values.append('(%s)' % ', '.join(':%s_%d' % (name, i) for name in names))
+                params.update(('%s_%d' % (name, i), row[name]) for name in names)
+
+            sql = 'INSERT INTO {table} ({columns}) VALUES {values} ' \
+                  'ON CONFLICT ({conflict}) DO UPDATE SET {updates} ' \
+                  'RETURNING id, (xmax = 0) AS inserted'.format(
+                      table=quote(table.name),
+                      columns=', '.join(map(quote, names)),
+                      values=', '.join(values),
+                      conflict=', '.join(map(quote, conflict_columns)),
+                      updates=', '.join(
+                          ('{0} = {1}.{0} + EXCLUDED.{0}' if name in increment_columns else '{0} = EXCLUDED.{0}')
+                          .format(quote(name), quote(table.name)) for name in updates))
+
+            result = db.session.execute(db.text(sql), params).fetchall()
+            n_inserted = sum(1 for row in result if row.inserted)
+            inserted += n_inserted
+            updated += len(batch) - n_inserted
+            cls._invalidate_ids(row.id for row in result if not row.inserted)
+            cls.on_bulk_change(batch)
+
+        return inserted, updated
+
+    @classmethod
+    def increment(cls, field, n=1, **filters):
+        '''
+        UPDATE ... SET field = field + n for the rows matching `filters`,
+        without loading them. Returns the number of rows changed.
+        '''
+        if not filters:
+            raise ValueError('increment needs filters, use increment_many for every row')
+        table = cls.__table__
+        statement = table.update() \
+            .where(db.and_(*[table.c[k] == v for k, v in filters.items()])) \
+            .values({field: table.c[field] + n}) \
+            .returning(*table.c)
+        rows = [dict(row) for row in db.session.execute(statement)]
+        cls._after_increment(rows)
+        return len(rows)
+
+    @classmethod
+    def increment_many(cls, field, rows, key_columns=None, batch_size=None):
+        '''
+        Add row[field] to `field` of the row identified by the `key_columns`
+        (default: the table's first unique constraint) of each of `rows`,
+        `batch_size` rows per UPDATE ... FROM (VALUES ...) statement. Rows
+        that do not exist are not created, see bulk_upsert for that.
+        Returns the number of rows changed.
+        '''
+        table = cls.__table__
+        dialect = db.engine.dialect
+        quote = dialect.identifier_preparer.quote
+        key_columns = list(key_columns or cls._unique_columns())
+        batch_size = batch_size or cls.BULK_BATCH_SIZE
+        names = key_columns + [field]
+        # untyped VALUES parameters would compare as text
+        casts = dict((name, table.c[name].type.compile(dialect=dialect)) for name in names)
+
+        changed = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+
+            # an UPDATE ... FROM changes a row once even if it joins several times
+            deltas = collections.OrderedDict()
+            for row in batch:
+                key = tuple(row[c] for c in key_columns)
+                deltas[key] = deltas.get(key, 0) + row[field]
+
+            values, params = [], dict(now=util.now())
+            for i, (key, delta) in enumerate(deltas.items()):
+                values.append('(%s)' % ', '.join(
+                    'CAST(:%s_%d AS %s)' % (name, i, casts[name]) for name in names))
+                params.update(('%s_%d' % (name, i), value) for name, value in zip(names, key + (delta,)))
+
+            sql = 'UPDATE {table} SET {field} = {table}.{field} + v.{field}, updated_on = :now ' \
+                  'FROM (VALUES {values}) AS v ({columns}) WHERE {join} ' \
+                  'RETURNING {table}.*'.format(
+                      table=quote(table.name),
+                      field=quote(field),
+                      values=', '.join(values),
+                      columns=', '.join(map(quote, names)),
+                      join=' AND '.join('{0}.{1} = v.{1}'.format(quote(table.name), quote(name))
+                                        for name in key_columns))
+
+            changed_rows = [dict(row) for row in db.session.execute(db.text(sql), params)]
+            cls._after_increment(changed_rows)
+            changed += len(changed_rows)
+
+        return changed
+
+    @classmethod
+    def _after_increment(cls, rows):
+        if not rows:
+            return
+        cls._invalidate_ids(row['id'] for row in rows)
+        cls.on_bulk_change(rows)
+
+    @classmethod
+    def _invalidate_ids(cls, ids):
+        # invalidate_cache for rows written without loading them
+        if not cls.USE_CACHE:
+            return
+        keys = [cls._cache_key_of(oid) for oid in ids]
+        if keys:
+            cls.cache_backend().delete(*keys)
+            db.session.info.setdefault(CACHE_INVALIDATION_KEY, set()).update((cls, key) for key in keys)
+
+    @classmethod
+    def on_bulk_change(cls, rows):
+        '''Called with the rows written by a bulk statement, which bypasses
+        the ORM events.'''
+        pass
+
+    @classmethod
+    def _unique_columns(cls):
+        for constraint in cls.__table__.constraints:
+            if isinstance(constraint, db.UniqueConstraint):
+                return [c.name for c in constraint.columns]
+        raise ValueError('%s has no unique constraint, pass conflict_columns' % cls.__name__)
 
 
 class Base(CommonColumnMixin, CRUDMixin, db.Model):
     __abstract__ = True
+    query_class = RoutingQuery
 
     def __repr__(self):
         return '<%s(id=%s)>' % (self.__class__.__name__, self.id)
 
 
 class User(Base):
+    USE_CACHE = True
+    # load_user hits this on every request; kept per process so it costs no
+    # network round trip, the short ttl bounds staleness in other workers
+    CACHE = cache.LRUCache(maxsize=4096, ttl=60)
 
     __tablename__ = "users"
 
+    __table_args__ = (
+        db.Index('ix_users_email_trgm', 'email',
+                 postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'}),
+        db.Index('ix_users_channel_name_trgm', 'channel_name',
+                 postgresql_using='gin', postgresql_ops={'channel_name': 'gin_trgm_ops'}),
+    )
+
     email = db.Column(db.String(255), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
@@ -156,14 +548,127 @@ class User(Base):
 
 
 class ChannelStatistic(Base):
+    USE_CACHE = True
 
     __tablename__ = 'channel_statistic'
 
     __table_args__ = (
         db.UniqueConstraint('date', 'channel_name'),
+        # one channel over a date range; updated_on lets the validators of
+        # a slice come from an index-only scan
+        db.Index('ix_channel_statistic_channel_name_date_updated', 'channel_name', 'date', 'updated_on'),
+        # keyset pagination, see CRUDMixin.list
+        db.Index('ix_channel_statistic_date_id', 'date', 'id'),
+        db.Index('ix_channel_statistic_channel_name_trgm', 'channel_name',
+                 postgresql_using='gin', postgresql_ops={'channel_name': 'gin_trgm_ops'}),
     )
 
     channel_name = db.Column(db.String, nullable=False)
     factor = db.Column(db.Float, nullable=False, default=1.)
     registered_num = db.Column(db.Integer, nullable=False, default=0)
     date = db.Column(db.Date, nullable=False, default=datetime.datetime.utcnow().date())
+
+    @classmethod
+    def on_bulk_change(cls, rows):
+        # refreshed by logic.rollup at commit
+        db.session.info.setdefault(ROLLUP_DIRTY_KEY, set()).update(
+            (row['date'], row['channel_name']) for row in rows)
+
+
+class ChannelStatisticRollupMixin(object):
+    """Sums of the daily ChannelStatistic rows of one channel in the period
+    starting at `period_start`, maintained by logic.rollup."""
+
+    channel_name = db.Column(db.String, nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    registered_num = db.Column(db.Integer, nullable=False, default=0)
+    # sum of registered_num * factor
+    activated_num = db.Column(db.Float, nullable=False, default=0.)
+
+
+class ChannelStatisticWeekly(ChannelStatisticRollupMixin, Base):
+
+    __tablename__ = 'channel_statistic_week'
+
+    __table_args__ = (
+        db.UniqueConstraint('period_start', 'channel_name'),
+    )
+
+
+class ChannelStatisticMonthly(ChannelStatisticRollupMixin, Base):
+
+    __tablename__ = 'channel_statistic_month'
+
+    __table_args__ = (
+        db.UniqueConstraint('period_start', 'channel_name'),
+    )
+
+
+class ChannelStatisticYearly(ChannelStatisticRollupMixin, Base):
+
+    __tablename__ = 'channel_statistic_year'
+
+    __table_args__ = (
+        db.UniqueConstraint('period_start', 'channel_name'),
+    )
+
+
+class ChannelDeviceSketch(Base):
+    """HyperLogLog sketch of the devices registered through a channel on a
+    day; unions of the daily sketches count the devices of any range."""
+
+    __tablename__ = 'channel_device_sketch'
+
+    __table_args__ = (
+        db.UniqueConstraint('date', 'channel_name'),
+    )
+
+    channel_name = db.Column(db.String, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    sketch = db.Column(db.LargeBinary, nullable=False)
+
+    @property
+    def hll(self):
+        return HyperLogLog.from_bytes(self.sketch)
+
+    @classmethod
+    def merge_sketches(cls, sketches):
+        '''
+        Fold the HyperLogLog of each (date, channel_name) of `sketches` into
+        the stored one. The rows are locked while merging, so concurrent
+        writers do not drop each other's devices.
+        '''
+        if not sketches:
+            return 0
+        keys = sorted(sketches)
+        empty = HyperLogLog().to_bytes()
+        now = util.now()
+
+        # make sure every row exists, then lock them in a stable order
+        values, params = [], dict(now=now, empty=empty)
+        for i, (day, channel_name) in enumerate(keys):
+            values.append('(:now, :now, :date_%d, :channel_name_%d, :empty)' % (i, i))
+            params.update({'date_%d' % i: day, 'channel_name_%d' % i: channel_name})
+        db.session.execute(db.text(
+            'INSERT INTO channel_device_sketch (created_on, updated_on, date, channel_name, sketch) '
+            'VALUES %s ON CONFLICT (date, channel_name) DO NOTHING' % ', '.join(values)), params)
+
+        rows = cls.query.set_use_master() \
+            .filter(db.tuple_(cls.date, cls.channel_name).in_(keys)) \
+            .order_by(cls.date, cls.channel_name) \
+            .with_for_update() \
+            .all()
+        for row in rows:
+            row.sketch = row.hll.merge(sketches[(row.date, row.channel_name)]).to_bytes()
+        db.session.flush()
+        return len(rows)
+
+    @classmethod
+    def union(cls, channel_name, start_date=None, end_date=None):
+        '''HyperLogLog of the devices of `channel_name` between the dates.'''
+        query = db.session.query(cls.sketch).filter(cls.channel_name == channel_name)
+        if start_date:
+            query = query.filter(cls.date >= start_date)
+        if end_date:
+            query = query.filter(cls.date <= end_date)
+        return HyperLogLog.union(HyperLogLog.from_bytes(row.sketch) for row in query)
@@ -0,0 +1,207 @@
+# statistic/server/routing.py
+
+
+import contextlib
+import os
+import random
+import threading
+import time
+
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, BaseQuery
+from sqlalchemy import event, text
+from sqlalchemy.sql.expression import Select
+
+from statistic.server.util.stat import getEngine
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# seconds to wait for a replica connection before giving up on it
+REPLICA_CONNECT_TIMEOUT = 3
+
+
+class Replica(object):
+
+    # seconds the replica is behind the primary, 0 when it replayed everything it received
+    LAG_SQL = text('''
+        SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+               END
+    ''')
+    # the same before postgres 10 renamed xlog to wal
+    LAG_SQL_9 = text('''
+        SELECT CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+               END
+    ''')
+
+    def __init__(self, uri):
+        self.uri = uri
+        # unknown until the first check, reads stay on the primary till then
+        self.healthy = False
+        self.lag = None
+
+    @property
+    def engine(self):
+        return getEngine(self.uri, connect_args={'connect_timeout': REPLICA_CONNECT_TIMEOUT})
+
+    def lag_sql(self, connection):
+        version = connection.dialect.server_version_info or ()
+        return self.LAG_SQL if version >= (10,) else self.LAG_SQL_9
+
+    def check(self, max_lag):
+        try:
+            with self.engine.connect() as connection:
+                self.lag = connection.scalar(self.lag_sql(connection))
+        except Exception as e:
+            self.lag = None
+            self.healthy = False
+            logger.warning('replica %s is unreachable: %r', self.uri.rsplit('@', 1)[-1], e)
+        else:
+            self.healthy = self.lag <= max_lag
+            if not self.healthy:
+                logger.warning('replica %s lags %ss behind', self.uri.rsplit('@', 1)[-1], self.lag)
+        return self.healthy
+
+
+class ReplicaPool(object):
+    '''
+    Read replicas of the primary database. Their health and replication lag
+    are checked every `check_interval` seconds by a background thread, so
+    requests never wait on a slow or dead replica; replicas that fail or lag
+    more than `max_lag` seconds are skipped until a later check passes.
+    '''
+
+    def __init__(self, uris, max_lag=30, check_interval=10):
+        self.replicas = [Replica(uri) for uri in uris]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    def _ensure_checker(self):
+        # threads do not survive a fork, every uwsgi worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._run, name='replica-checker')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(self.check_interval)
+
+    def choose(self):
+        '''Engine of a random healthy replica, None when there is none.'''
+        if not self.replicas:
+            return None
+        self._ensure_checker()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        return random.choice(healthy).engine if healthy else None
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Sends ORM/select reads to a replica and everything else to the primary.
+    Flushes, non-select statements, `info['use_master']` and any read after
+    a write in the same transaction go to the primary.
+    '''
+
+    def __init__(self, db, **options):
+        self._pinned_to_master = False
+        self._replica = None
+        super(RoutingSession, self).__init__(db, **options)
+        self.replicas = db.get_replica_pool(self.app)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super(RoutingSession, self).get_bind(mapper, clause)
+        if self.replicas is None or bind is not self.bind:
+            # no replicas configured, or a model with its own __bind_key__
+            return bind
+
+        if self._flushing or not isinstance(clause, Select):
+            self._pinned_to_master = True
+        if self._pinned_to_master or self.info.get('use_master'):
+            return bind
+
+        # stick to one replica for the whole transaction
+        if self._replica is None:
+            self._replica = self.replicas.choose() or bind
+        return self._replica
+
+    @contextlib.contextmanager
+    def using_master(self):
+        missing = object()
+        use_master = self.info.get('use_master', missing)
+        self.info['use_master'] = True
+        try:
+            yield self
+        finally:
+            if use_master is missing:
+                del self.info['use_master']
+            else:
+                self.info['use_master'] = use_master
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _reset_routing(session, transaction):
+    if transaction.parent is None:
+        session._pinned_to_master = False
+        session._replica = None
+
+
+class RoutingQuery(BaseQuery):
+
+    _use_master = False
+
+    def set_use_master(self, use_master=True):
+        query = self._clone()
+        query._use_master = use_master
+        return query
+
+    def __iter__(self):
+        if not self._use_master or not isinstance(self.session, RoutingSession):
+            return super(RoutingQuery, self).__iter__()
+        # the statement runs here, the returned iterator only builds objects
+        with self.session.using_master():
+            return super(RoutingQuery, self).__iter__()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''
+    SQLAlchemy whose sessions route reads to SQLALCHEMY_REPLICA_URIS, see
+    RoutingSession. Without replicas everything goes to the primary.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self._replica_pools = {}
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_replica_pool(self, app):
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+        if not uris:
+            return None
+        pool = self._replica_pools.get(app)
+        if pool is None:
+            pool = self._replica_pools.setdefault(app, ReplicaPool(
+                uris,
+                max_lag=app.config.get('SQLALCHEMY_REPLICA_MAX_LAG', 30),
+                check_interval=app.config.get('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 10)))
+        return pool
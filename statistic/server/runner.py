@@ -14,6 +14,8 @@ from flask_bootstrap import Bootstrap
 import logging.config
 import statistic.server.config as config
 from statistic.server.models import init_model
+from statistic.server.logic.rollup import init_rollup
+from statistic.server.logic.ingest import init_ingest
 ################
 #### config ####
 ################
@@ -42,6 +44,8 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 bootstrap = Bootstrap(app)
 init_model(app)
+init_rollup()
+init_ingest(app)
 
 ###################
 ### blueprints ####
@@ -67,7 +71,7 @@ login_manager.login_message_category = 'danger'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter(User.id == int(user_id)).first()
+    return User.get(int(user_id))
 
 
 ########################
@@ -1,15 +1,20 @@
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
-from distutils.version import StrictVersion
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from datetime import date, datetime, timedelta
 import bisect
+import collections
+import contextlib
 import functools
+import importlib
 import itertools
+import json
 import operator
+import os
 import random
 import re
-import requests
+from stat import S_ISDIR
 import string
 import sys
+import tempfile
 import time
 
 import unicodedata
@@ -23,9 +28,21 @@ import logging
 logger = logging.getLogger(__name__)
 
 from statistic.server.config import PARTNER_DEFAULT_TZ
+from statistic.server.util import alert
 
 from flask import request
 
+@functools.lru_cache(maxsize=None)
+def optional_import(name):
+    '''Module `name`, imported on first use, or None when it is not
+    installed; keeps heavy optional dependencies such as numpy out of the
+    startup of every worker.'''
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
 # string util
 def random_string(length, characters=string.ascii_letters + string.digits):
     return ''.join(random.SystemRandom().choice(characters) for _ in range(length))
@@ -42,9 +59,64 @@ def random_uuid_string():
 def string_join(sep, *data):
     return sep.join(map(str, data))
 
-# performance matters
-none_character_table = dict.fromkeys(
-    i for i in range(sys.maxunicode) if unicodedata.category(chr(i)).startswith('P'))
+# performance matters: scanning every code point takes a while, so the table
+# is built on first use instead of at import and kept on disk per unicode version,
+# in a directory only this user can write to
+PUNCTUATION_TABLE_DIR = os.path.join(tempfile.gettempdir(), 'statistic-%d' % os.getuid())
+
+_none_character_table = None
+
+
+def get_none_character_table():
+    global _none_character_table
+    if _none_character_table is None:
+        _none_character_table = _load_none_character_table()
+    return _none_character_table
+
+
+def _is_private(st):
+    # owned by us and writable by nobody else
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _private_dir(path):
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logger.warning('cannot create %s: %r', path, e)
+        return None
+    st = os.lstat(path)
+    if not S_ISDIR(st.st_mode) or not _is_private(st):
+        logger.warning('not using %s, somebody else can write to it', path)
+        return None
+    return path
+
+
+def _load_none_character_table():
+    directory = _private_dir(PUNCTUATION_TABLE_DIR)
+    path = directory and os.path.join(directory, 'statistic-punctuation-%s-%s.json' % (
+        unicodedata.unidata_version, sys.maxunicode))
+    if path:
+        try:
+            with open(path) as f:
+                if _is_private(os.fstat(f.fileno())):
+                    return dict.fromkeys(int(i) for i in json.load(f))
+                logger.warning('not using %s, somebody else can write to it', path)
+        except (IOError, ValueError, TypeError):
+            pass
+
+    codepoints = [i for i in range(sys.maxunicode) if unicodedata.category(chr(i)).startswith('P')]
+    if path:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(codepoints, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('cannot save punctuation table to %s: %r', path, e)
+    return dict.fromkeys(codepoints)
 
 
 def purge_text(text):
@@ -52,7 +124,7 @@ def purge_text(text):
     >>> purge_text('abc 123 ！？。defg')
     'abc123defg'
     '''
-    pure_text = text.translate(none_character_table)
+    pure_text = text.translate(get_none_character_table())
     return re.sub(r'\s', '', pure_text)
 
 
@@ -68,6 +140,34 @@ def to_aware_datetime(dt, tz):
         return dt.replace(tzinfo=pytz.utc).astimezone(tz)
 
 
+# the fixed formats our databases and clients send, parsed without dateutil
+_iso_datetime_re = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(?:(Z)|([+-])(\d{2}):?(\d{2}))?$')
+_iso_date_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})$')
+
+
+def _parse_iso_datetime(timestr):
+    m = _iso_datetime_re.match(timestr) if isinstance(timestr, str) else None
+    if m is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, zulu, sign, tz_hour, tz_minute = m.groups()
+    if zulu:
+        tzinfo = pytz.utc
+    elif sign:
+        offset = int(tz_hour) * 60 + int(tz_minute)
+        tzinfo = pytz.FixedOffset(-offset if sign == '-' else offset)
+    else:
+        tzinfo = None
+
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                        int(fraction.ljust(6, '0')) if fraction else 0, tzinfo=tzinfo)
+    except ValueError:
+        # out of range fields, let dateutil raise its usual error
+        return None
+
+
 def parse_datetime(timestr, tz=PARTNER_DEFAULT_TZ):
     """
     >>> parse_datetime('2015-10-13 12:34:56.78910')
@@ -79,11 +179,48 @@ def parse_datetime(timestr, tz=PARTNER_DEFAULT_TZ):
     >>> parse_datetime('2015-10-13 12:34:56.78910+08:00')
     datetime.datetime(2015, 10, 13, 12, 34, 56, 789100, tzinfo=<DstTzInfo 'Asia/Shanghai' CST+8:00:00 STD>)
     """
-    return to_aware_datetime(date_parser.parse(timestr), tz)
+    dt = _parse_iso_datetime(timestr)
+    if dt is None:
+        dt = date_parser.parse(timestr)
+    return to_aware_datetime(dt, tz)
+
+
+def parse_datetimes(timestrs, tz=PARTNER_DEFAULT_TZ):
+    '''
+    parse_datetime for a column of strings, parsing repeated values once.
+
+    >>> [dt.hour for dt in parse_datetimes(['2015-10-13 12:00:00', '2015-10-13T12:00:00Z', '2015-10-13 12:00:00+08:00'])]
+    [20, 20, 12]
+    '''
+    parsed = {}
+    result = []
+    for timestr in timestrs:
+        dt = parsed.get(timestr)
+        if dt is None:
+            dt = parsed[timestr] = parse_datetime(timestr, tz=tz)
+        result.append(dt)
+    return result
 
 
 def parse_date(datestr):
-    return date_parser.parse(datestr).date()
+    '''
+    >>> parse_date('2015-10-13')
+    datetime.date(2015, 10, 13)
+
+    >>> parse_date('2015-10-13 23:34:56+00:00')
+    datetime.date(2015, 10, 13)
+    '''
+    m = _iso_date_re.match(datestr) if isinstance(datestr, str) else None
+    if m is not None:
+        try:
+            return date(*map(int, m.groups()))
+        except ValueError:
+            pass
+
+    dt = _parse_iso_datetime(datestr)
+    if dt is None:
+        dt = date_parser.parse(datestr)
+    return dt.date()
 
 
 def unparse_datetime(dt, fmt=None, tz=PARTNER_DEFAULT_TZ):
@@ -122,8 +259,110 @@ def unparse_date(dt, fmt=None):
         return dt.strftime(fmt)
 
 
+class _Day(object):
+    # boundaries of the day containing the naive utc datetime `utc`, in `tz`
+
+    def __init__(self, utc, tz):
+        self.tz = tz
+        local = to_aware_datetime(utc, tz)
+        self.start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.end = (local + timedelta(hours=24)).replace(hour=0, minute=0, second=0, microsecond=0) \
+            - timedelta(seconds=1)
+        self.start_utc = to_aware_datetime(self.start, pytz.utc).replace(tzinfo=None)
+        self.end_utc = to_aware_datetime(self.end, pytz.utc).replace(tzinfo=None)
+
+        # shifting by a cached offset is only right when the offset holds all day
+        self.offset = local.utcoffset()
+        self.tzinfo = local.tzinfo
+        self.fixed_offset = \
+            to_aware_datetime(self.start_utc, tz).utcoffset() == to_aware_datetime(self.end_utc, tz).utcoffset()
+
+    def __contains__(self, utc):
+        return self.start_utc <= utc < self.end_utc + timedelta(seconds=1)
+
+    def localize(self, utc):
+        if self.fixed_offset:
+            return (utc + self.offset).replace(tzinfo=self.tzinfo)
+        return to_aware_datetime(utc, self.tz)
+
+
+class Clock(object):
+    '''
+    Current time in `tz`. The boundaries of the current day are computed once
+    and reused until midnight, so now(), start_of_day(), end_of_day() and
+    seconds_left_today() skip the pytz conversions on the hot path.
+    '''
+
+    def __init__(self, tz=PARTNER_DEFAULT_TZ):
+        self.tz = tz
+        self._today = None
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def _day(self, utc):
+        today = self._today
+        if today is None or utc not in today:
+            today = self._today = _Day(utc, self.tz)
+        return today
+
+    def now(self):
+        utc = self.utcnow()
+        return self._day(utc).localize(utc)
+
+    def start_of_day(self):
+        return self._day(self.utcnow()).start
+
+    def end_of_day(self):
+        return self._day(self.utcnow()).end
+
+    def seconds_left_today(self):
+        utc = self.utcnow()
+        return int((self._day(utc).end_utc - utc).total_seconds())
+
+
+class FrozenClock(Clock):
+    '''
+    Clock standing still at `dt` (naive datetimes are utc) until moved with tick().
+    '''
+
+    def __init__(self, dt, tz=PARTNER_DEFAULT_TZ):
+        super(FrozenClock, self).__init__(tz=tz)
+        self._utcnow = to_aware_datetime(dt, pytz.utc).replace(tzinfo=None)
+
+    def utcnow(self):
+        return self._utcnow
+
+    def tick(self, seconds=1):
+        self._utcnow += timedelta(seconds=seconds)
+
+
+clock = Clock()
+
+
+def set_clock(new_clock):
+    '''Replace the clock behind now() and friends, returns the previous one.'''
+    global clock
+    previous, clock = clock, new_clock
+    return previous
+
+
+@contextlib.contextmanager
+def frozen_clock(dt):
+    '''
+    >>> with frozen_clock(datetime(2015, 10, 13, 15, 59)):
+    ...     now().isoformat(), start_of_day().isoformat(), seconds_left_today()
+    ('2015-10-13T23:59:00+08:00', '2015-10-13T00:00:00+08:00', 59)
+    '''
+    previous = set_clock(FrozenClock(dt))
+    try:
+        yield clock
+    finally:
+        set_clock(previous)
+
+
 def now():
-    return to_aware_datetime(datetime.utcnow(), PARTNER_DEFAULT_TZ)
+    return clock.now()
 
 
 def start_of_hour(dt=None):
@@ -132,15 +371,26 @@ def start_of_hour(dt=None):
 
 
 def start_of_day(dt=None):
-    dt = dt or now()
+    if not dt:
+        return clock.start_of_day()
     return dt.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
 def end_of_day(dt=None):
-    dt = dt or now()
+    if not dt:
+        return clock.end_of_day()
     return start_of_day(dt=dt + timedelta(hours=24)) - timedelta(seconds=1)
 
 
+def start_of_week(dt=None):
+    '''
+    >>> start_of_week(datetime(2015, 10, 15, 12, 34))
+    datetime.datetime(2015, 10, 12, 0, 0)
+    '''
+    dt = dt or now()
+    return start_of_day(dt) - timedelta(days=dt.weekday())
+
+
 def start_of_month(dt=None):
     dt = dt or now()
     return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -168,7 +418,7 @@ def start_of_last_year(dt=None):
 
 
 def seconds_left_today():
-    return int((end_of_day() - now()).total_seconds())
+    return clock.seconds_left_today()
 
 
 def timestamp_in_ms(dt=None):
@@ -191,8 +441,9 @@ def is_at_night():
 
 
 def is_apple_at_work():
-    hour = now().hour
-    minute = now().minute
+    current_time = now()
+    hour = current_time.hour
+    minute = current_time.minute
     return 2 <= hour < 8 or (hour == 8 and minute <= 30)
 
 
@@ -265,6 +516,41 @@ def null_last_sorted(iterable, key=lambda x: (x is None, x), reverse=False):
     return sorted(iterable, key=key, reverse=reverse)
 
 
+# concurrency util
+def scatter_gather(fn, args, max_workers=None, timeout=None):
+    '''
+    Run ``fn(arg)`` for every arg on a bounded thread pool and yield
+    ``(arg, result, error)`` in completion order. ``timeout`` is the number of
+    seconds allowed from submission; calls still running by then are yielded
+    with a ``TimeoutError`` and abandoned.
+
+    >>> sorted(r for _, r, _ in scatter_gather(lambda x: x * 2, [1, 2, 3]))
+    [2, 4, 6]
+
+    >>> [type(e).__name__ for _, _, e in scatter_gather(lambda x: 1 // x, [0])]
+    ['ZeroDivisionError']
+    '''
+    args = list(args)
+    if not args:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(args))
+    futures = dict((executor.submit(fn, arg), arg) for arg in args)
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            pending.discard(future)
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+    except FutureTimeoutError:
+        for future in pending:
+            future.cancel()
+            yield futures[future], None, TimeoutError('no result after %s seconds' % timeout)
+    finally:
+        # never block the caller on abandoned calls
+        executor.shutdown(wait=False)
+
+
 # redis util
 def redis_key(prefix, oid, what):
     return ':'.join([prefix, oid, what])
@@ -314,6 +600,61 @@ def random_with_weight(choices_and_weights):
     return choices[bisect.bisect(cumdist, x)]
 
 
+class WeightedSampler(object):
+    '''
+    Weighted random choice like random_with_weight, built once from
+    `choices_and_weights` (Walker/Vose alias tables, O(n)) after which every
+    draw is O(1). Reuse one sampler for repeated draws over the same weights.
+
+    >>> sampler = WeightedSampler([('a', 1), ('b', 0), ('c', 3)])
+    >>> sampler.draw() in ('a', 'c')
+    True
+    >>> sorted(set(sampler.sample(1000)))
+    ['a', 'c']
+    '''
+
+    def __init__(self, choices_and_weights, rng=random):
+        self.choices, weights = zip(*choices_and_weights)
+        self.rng = rng
+
+        n, total = len(weights), float(sum(weights))
+        if total <= 0:
+            raise ValueError('weights must add up to more than 0')
+
+        prob = [w * n / total for w in weights]
+        alias = list(range(n))
+        small = [i for i, p in enumerate(prob) if p < 1]
+        large = [i for i, p in enumerate(prob) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] += prob[s] - 1
+            (small if prob[l] < 1 else large).append(l)
+        # whatever is left is 1 up to rounding errors
+        for i in small + large:
+            prob[i] = 1.0
+
+        self.prob, self.alias = prob, alias
+        numpy = optional_import('numpy')
+        if numpy is not None:
+            self._prob_array, self._alias_array = numpy.array(prob), numpy.array(alias)
+
+    def draw(self):
+        x = self.rng.random() * len(self.prob)
+        i = int(x)
+        return self.choices[i] if x - i < self.prob[i] else self.choices[self.alias[i]]
+
+    def sample(self, k):
+        '''`k` independent draws, vectorized when numpy is installed.'''
+        numpy = optional_import('numpy')
+        if numpy is None or self.rng is not random:
+            return [self.draw() for _ in range(k)]
+
+        i = numpy.random.randint(len(self.prob), size=k)
+        picks = numpy.where(numpy.random.random(k) < self._prob_array[i], i, self._alias_array[i])
+        return [self.choices[j] for j in picks]
+
+
 def del_bad_cdn(cdns, bad_cdn):
     if bad_cdn and len(cdns) > 1:
         return [cdn for cdn in cdns if cdn.push_host != bad_cdn]
@@ -365,45 +706,128 @@ def client_auth_signature(req, default=None):
     return req.headers.get('X-Zzb-Auth-Signature', default)
 
 
+# user agent util
 # reform from http://detectmobilebrowsers.com/download/python
-def is_mobile(ua):
+_mobile_ua_re = re.compile(
+    r"(android|bb\\d+|meego).+mobile|avantgo|bada\\/|blackberry|blazer|compal|elaine|fennec|hiptop|iemobile|ip(hone|od)|iris|kindle|lge |maemo|midp|mmp|mobile.+firefox|netfront|opera m(ob|in)i|palm( os)?|phone|p(ixi|re)\\/|plucker|pocket|psp|series(4|6)0|symbian|treo|up\\.(browser|link)|vodafone|wap|windows ce|xda|xiino", re.I | re.M)
+_mobile_ua_prefix_re = re.compile(
+    r"1207|6310|6590|3gso|4thp|50[1-6]i|770s|802s|a wa|abac|ac(er|oo|s\\-)|ai(ko|rn)|al(av|ca|co)|amoi|an(ex|ny|yw)|aptu|ar(ch|go)|as(te|us)|attw|au(di|\\-m|r |s )|avan|be(ck|ll|nq)|bi(lb|rd)|bl(ac|az)|br(e|v)w|bumb|bw\\-(n|u)|c55\\/|capi|ccwa|cdm\\-|cell|chtm|cldc|cmd\\-|co(mp|nd)|craw|da(it|ll|ng)|dbte|dc\\-s|devi|dica|dmob|do(c|p)o|ds(12|\\-d)|el(49|ai)|em(l2|ul)|er(ic|k0)|esl8|ez([4-7]0|os|wa|ze)|fetc|fly(\\-|_)|g1 u|g560|gene|gf\\-5|g\\-mo|go(\\.w|od)|gr(ad|un)|haie|hcit|hd\\-(m|p|t)|hei\\-|hi(pt|ta)|hp( i|ip)|hs\\-c|ht(c(\\-| |_|a|g|p|s|t)|tp)|hu(aw|tc)|i\\-(20|go|ma)|i230|iac( |\\-|\\/)|ibro|idea|ig01|ikom|im1k|inno|ipaq|iris|ja(t|v)a|jbro|jemu|jigs|kddi|keji|kgt( |\\/)|klon|kpt |kwc\\-|kyo(c|k)|le(no|xi)|lg( g|\\/(k|l|u)|50|54|\\-[a-w])|libw|lynx|m1\\-w|m3ga|m50\\/|ma(te|ui|xo)|mc(01|21|ca)|m\\-cr|me(rc|ri)|mi(o8|oa|ts)|mmef|mo(01|02|bi|de|do|t(\\-| |o|v)|zz)|mt(50|p1|v )|mwbp|mywa|n10[0-2]|n20[2-3]|n30(0|2)|n50(0|2|5)|n7(0(0|1)|10)|ne((c|m)\\-|on|tf|wf|wg|wt)|nok(6|i)|nzph|o2im|op(ti|wv)|oran|owg1|p800|pan(a|d|t)|pdxg|pg(13|\\-([1-8]|c))|phil|pire|pl(ay|uc)|pn\\-2|po(ck|rt|se)|prox|psio|pt\\-g|qa\\-a|qc(07|12|21|32|60|\\-[2-7]|i\\-)|qtek|r380|r600|raks|rim9|ro(ve|zo)|s55\\/|sa(ge|ma|mm|ms|ny|va)|sc(01|h\\-|oo|p\\-)|sdk\\/|se(c(\\-|0|1)|47|mc|nd|ri)|sgh\\-|shar|sie(\\-|m)|sk\\-0|sl(45|id)|sm(al|ar|b3|it|t5)|so(ft|ny)|sp(01|h\\-|v\\-|v )|sy(01|mb)|t2(18|50)|t6(00|10|18)|ta(gt|lk)|tcl\\-|tdg\\-|tel(i|m)|tim\\-|t\\-mo|to(pl|sh)|ts(70|m\\-|m3|m5)|tx\\-9|up(\\.b|g1|si)|utst|v400|v750|veri|vi(rg|te)|vk(40|5[0-3]|\\-v)|vm40|voda|vulc|vx(52|53|60|61|70|80|81|83|85|98)|w3c(\\-| )|webc|whit|wi(g |nc|nw)|wmlb|wonu|x700|yas\\-|your|zeto|zte\\-", re.I | re.M)
+_ios_ua_re = re.compile(r"(iPad|iPhone)|iPod")
+_micromessenger_ua_re = re.compile(r"(MicroMessenger|micromessenger)")
+# mobile header | web header
+_legal_ua_re = re.compile(r"zbd|okhttp\/2\.5\.0")
+
+UserAgentClass = collections.namedtuple('UserAgentClass', ['mobile', 'ios', 'wechat', 'legal'])
+
+_unknown_user_agent = UserAgentClass(mobile=False, ios=False, wechat=False, legal=False)
+
+# real traffic only has a few thousand distinct user agents
+USER_AGENT_CACHE_SIZE = 8192
+
+
+@functools.lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def classify_user_agent(ua):
+    '''
+    >>> classify_user_agent('Mozilla/5.0 (iPhone; CPU iPhone OS 9_1 like Mac OS X) Mobile/13B143 MicroMessenger/6.3.9')
+    UserAgentClass(mobile=True, ios=True, wechat=True, legal=False)
+
+    >>> classify_user_agent('okhttp/2.5.0')
+    UserAgentClass(mobile=False, ios=False, wechat=False, legal=True)
+
+    >>> classify_user_agent(None)
+    UserAgentClass(mobile=False, ios=False, wechat=False, legal=False)
+    '''
     if not ua:
-        return False
+        return _unknown_user_agent
 
-    reg_b = re.compile(
-        r"(android|bb\\d+|meego).+mobile|avantgo|bada\\/|blackberry|blazer|compal|elaine|fennec|hiptop|iemobile|ip(hone|od)|iris|kindle|lge |maemo|midp|mmp|mobile.+firefox|netfront|opera m(ob|in)i|palm( os)?|phone|p(ixi|re)\\/|plucker|pocket|psp|series(4|6)0|symbian|treo|up\\.(browser|link)|vodafone|wap|windows ce|xda|xiino", re.I | re.M)
-    reg_v = re.compile(
-        r"1207|6310|6590|3gso|4thp|50[1-6]i|770s|802s|a wa|abac|ac(er|oo|s\\-)|ai(ko|rn)|al(av|ca|co)|amoi|an(ex|ny|yw)|aptu|ar(ch|go)|as(te|us)|attw|au(di|\\-m|r |s )|avan|be(ck|ll|nq)|bi(lb|rd)|bl(ac|az)|br(e|v)w|bumb|bw\\-(n|u)|c55\\/|capi|ccwa|cdm\\-|cell|chtm|cldc|cmd\\-|co(mp|nd)|craw|da(it|ll|ng)|dbte|dc\\-s|devi|dica|dmob|do(c|p)o|ds(12|\\-d)|el(49|ai)|em(l2|ul)|er(ic|k0)|esl8|ez([4-7]0|os|wa|ze)|fetc|fly(\\-|_)|g1 u|g560|gene|gf\\-5|g\\-mo|go(\\.w|od)|gr(ad|un)|haie|hcit|hd\\-(m|p|t)|hei\\-|hi(pt|ta)|hp( i|ip)|hs\\-c|ht(c(\\-| |_|a|g|p|s|t)|tp)|hu(aw|tc)|i\\-(20|go|ma)|i230|iac( |\\-|\\/)|ibro|idea|ig01|ikom|im1k|inno|ipaq|iris|ja(t|v)a|jbro|jemu|jigs|kddi|keji|kgt( |\\/)|klon|kpt |kwc\\-|kyo(c|k)|le(no|xi)|lg( g|\\/(k|l|u)|50|54|\\-[a-w])|libw|lynx|m1\\-w|m3ga|m50\\/|ma(te|ui|xo)|mc(01|21|ca)|m\\-cr|me(rc|ri)|mi(o8|oa|ts)|mmef|mo(01|02|bi|de|do|t(\\-| |o|v)|zz)|mt(50|p1|v )|mwbp|mywa|n10[0-2]|n20[2-3]|n30(0|2)|n50(0|2|5)|n7(0(0|1)|10)|ne((c|m)\\-|on|tf|wf|wg|wt)|nok(6|i)|nzph|o2im|op(ti|wv)|oran|owg1|p800|pan(a|d|t)|pdxg|pg(13|\\-([1-8]|c))|phil|pire|pl(ay|uc)|pn\\-2|po(ck|rt|se)|prox|psio|pt\\-g|qa\\-a|qc(07|12|21|32|60|\\-[2-7]|i\\-)|qtek|r380|r600|raks|rim9|ro(ve|zo)|s55\\/|sa(ge|ma|mm|ms|ny|va)|sc(01|h\\-|oo|p\\-)|sdk\\/|se(c(\\-|0|1)|47|mc|nd|ri)|sgh\\-|shar|sie(\\-|m)|sk\\-0|sl(45|id)|sm(al|ar|b3|it|t5)|so(ft|ny)|sp(01|h\\-|v\\-|v )|sy(01|mb)|t2(18|50)|t6(00|10|18)|ta(gt|lk)|tcl\\-|tdg\\-|tel(i|m)|tim\\-|t\\-mo|to(pl|sh)|ts(70|m\\-|m3|m5)|tx\\-9|up(\\.b|g1|si)|utst|v400|v750|veri|vi(rg|te)|vk(40|5[0-3]|\\-v)|vm40|voda|vulc|vx(52|53|60|61|70|80|81|83|85|98)|w3c(\\-| )|webc|whit|wi(g |nc|nw)|wmlb|wonu|x700|yas\\-|your|zeto|zte\\-", re.I | re.M)
+    return UserAgentClass(
+        mobile=bool(_mobile_ua_re.search(ua) or _mobile_ua_prefix_re.search(ua[0:4])),
+        ios=bool(_ios_ua_re.search(ua)),
+        wechat=bool(_micromessenger_ua_re.search(ua)),
+        legal=bool(_legal_ua_re.search(ua)),
+    )
 
-    b = reg_b.search(ua)
-    v = reg_v.search(ua[0:4])
-    return bool(b or v)
+
+def is_mobile(ua):
+    return classify_user_agent(ua).mobile
 
 
 def is_ios(ua):
-    reg = re.compile(r"(iPad|iPhone)|iPod")
-    r = reg.search(ua)
-    return True if r else False
+    return classify_user_agent(ua).ios
 
 #微信浏览器
 def is_micromessenger(ua):
-    reg = re.compile(r"(MicroMessenger|micromessenger)")
-    r = reg.search(ua)
-    return True if r else False
+    return classify_user_agent(ua).wechat
 
 
 def is_legal_agent(agent):
-    if not agent:
-        return False
+    return classify_user_agent(agent).legal
+
+
+def classify_user_agents(uas):
+    '''
+    Batch classify_user_agent, e.g. for a day of access log lines: every
+    distinct user agent is classified once. Returns one column per
+    UserAgentClass field aligned with `uas`, numpy bool arrays when numpy is
+    installed and lists otherwise.
+
+    >>> columns = classify_user_agents(['okhttp/2.5.0', None, 'okhttp/2.5.0'])
+    >>> [bool(legal) for legal in columns['legal']]
+    [True, False, True]
+    '''
+    index, uniques, codes = {}, [], []
+    for ua in uas:
+        code = index.get(ua)
+        if code is None:
+            code = index[ua] = len(uniques)
+            uniques.append(ua)
+        codes.append(code)
+
+    # bypass the per-request lru cache, log files would only thrash it
+    classes = [classify_user_agent.__wrapped__(ua) for ua in uniques]
 
-    # mobile header
-    reg_m = re.compile(r"zbd")
-    # web header
-    reg_w = re.compile(r"okhttp\/2\.5\.0")
+    numpy = optional_import('numpy')
+    if numpy is not None:
+        table = numpy.array(classes, dtype=bool).reshape(len(classes), len(UserAgentClass._fields))
+        rows = table[numpy.array(codes, dtype=numpy.intp)]
+        return dict((field, rows[:, i]) for i, field in enumerate(UserAgentClass._fields))
 
-    m = reg_m.search(agent)
-    w = reg_w.search(agent)
-    return bool(m or w)
+    return dict((field, [classes[code][i] for code in codes]) for i, field in enumerate(UserAgentClass._fields))
+
+
+def count_user_agents(uas):
+    '''
+    >>> sorted(count_user_agents(['okhttp/2.5.0', 'zbd/3.8 (iPhone)', None]).items())
+    [('ios', 1), ('legal', 2), ('mobile', 1), ('total', 3), ('wechat', 0)]
+    '''
+    counts = dict.fromkeys(UserAgentClass._fields, 0)
+    total = 0
+    for ua, n in collections.Counter(uas).items():
+        total += n
+        for field, value in zip(UserAgentClass._fields, classify_user_agent.__wrapped__(ua)):
+            if value:
+                counts[field] += n
+    counts['total'] = total
+    return counts
+
+
+def count_header_values(headers, *names):
+    '''
+    Count the values of the X-Zzb-* headers `names` over many requests'
+    `headers` mappings, e.g. a channel/platform breakdown of a day of traffic.
+
+    >>> rows = [{'X-Zzb-Dist-Channel': 'a', 'X-Zzb-Device-Platform': 'ios'},
+    ...         {'X-Zzb-Dist-Channel': 'a', 'X-Zzb-Device-Platform': 'ios'},
+    ...         {'X-Zzb-Device-Platform': 'android'}]
+    >>> sorted(count_header_values(rows, 'X-Zzb-Device-Platform').items())
+    [('android', 1), ('ios', 2)]
+    >>> count_header_values(rows, 'X-Zzb-Dist-Channel', 'X-Zzb-Device-Platform')[('a', 'ios')]
+    2
+    '''
+    if len(names) == 1:
+        name = names[0]
+        return collections.Counter(h.get(name) for h in headers)
+    return collections.Counter(tuple(h.get(name) for name in names) for h in headers)
 
 
 def url_for_app(what, oid=None):
@@ -428,7 +852,44 @@ def _host_region(host):
     return host.split('.')[0].split('-')[1]
 
 
-class ClientVersion(StrictVersion):
+# same grammar as distutils' StrictVersion: N.N[.N][{a|b}N]
+_version_re = re.compile(r'^(\d+)\.(\d+)(?:\.(\d+))?(?:([ab])(\d+))?$', re.ASCII)
+
+# feature gates compare the same few client versions over and over
+VERSION_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=VERSION_CACHE_SIZE)
+def version_key(vstring, device_platform=None):
+    '''
+    Comparable tuple of a client version, ordered like StrictVersion.
+
+    >>> version_key('3.8.11', device_platform='ios') == version_key('3.8.1')
+    True
+
+    >>> version_key('3.8') < version_key('3.8.1a1') < version_key('3.8.1')
+    True
+    '''
+    if vstring and device_platform == 'ios':
+        index = vstring.rfind('.')
+        # len('3.8.2') - '3.8.2'.rfind('.') == 2    # old-style
+        # len('3.8.20') - '3.8.20'.rfind('.') == 3  # new-style
+        if len(vstring) - index >= 3:
+            # new-style iOS 版本：移除 ios 大/小号标志 vstring[index+1]
+            vstring = vstring[:index+1] + vstring[index+2:]
+
+    m = _version_re.match(vstring)
+    if not m:
+        raise ValueError("invalid version number '%s'" % vstring)
+
+    major, minor, patch, prerelease, prerelease_num = m.groups()
+    version = (int(major), int(minor), int(patch or 0))
+    # a final release sorts after its pre-releases
+    return version, (0, prerelease, int(prerelease_num)) if prerelease else (1,)
+
+
+@functools.total_ordering
+class ClientVersion(object):
     '''
     >>> ClientVersion('3.8.11', device_platform='ios') == ClientVersion('3.8.1')
     True
@@ -441,17 +902,56 @@ class ClientVersion(StrictVersion):
 
     >>> ClientVersion('3.8.1', device_platform='ios') == ClientVersion('3.8.11', device_platform='ios')
     True
+
+    >>> ClientVersion('3.8.1') == None, ClientVersion('3.8.1') != 381
+    (False, True)
+
+    >>> ClientVersion('3.8.1') < None
+    Traceback (most recent call last):
+    ...
+    TypeError: '<' not supported between instances of 'ClientVersion' and 'NoneType'
+
+    >>> {ClientVersion('3.8.11', device_platform='ios'): 'ok'}.get('3.8.1')
+    'ok'
     '''
     def __init__(self, vstring=None, device_platform=None):
-        if vstring and device_platform == 'ios':
-            index = vstring.rfind('.')
-            # len('3.8.2') - '3.8.2'.rfind('.') == 2    # old-style
-            # len('3.8.20') - '3.8.20'.rfind('.') == 3  # new-style
-            if len(vstring) - index >= 3:
-                # new-style iOS 版本：移除 ios 大/小号标志 vstring[index+1]
-                vstring = vstring[:index+1] + vstring[index+2:]
+        self.key = None
+        if vstring:
+            self.parse(vstring, device_platform=device_platform)
+
+    def parse(self, vstring, device_platform=None):
+        self.key = version_key(vstring, device_platform=device_platform)
+        self.version = self.key[0]
+        self.prerelease = self.key[1][1:] or None
+
+    def _key_of(self, other):
+        if isinstance(other, str):
+            return version_key(other)
+        if isinstance(other, ClientVersion):
+            return other.key
+        return NotImplemented
+
+    def __eq__(self, other):
+        key = self._key_of(other)
+        return key if key is NotImplemented else self.key == key
+
+    def __lt__(self, other):
+        key = self._key_of(other)
+        return key if key is NotImplemented else self.key < key
+
+    def __hash__(self):
+        # equal to its canonical string, so hash like it
+        return hash(str(self) if self.key is not None else None)
+
+    def __str__(self):
+        version = self.version if self.version[2] else self.version[:2]
+        vstring = '.'.join(map(str, version))
+        if self.prerelease:
+            vstring += '%s%d' % self.prerelease
+        return vstring
 
-        super(ClientVersion, self).__init__(vstring=vstring)
+    def __repr__(self):
+        return "%s ('%s')" % (type(self).__name__, str(self))
 
 
 def version_cmp(op, v1, v2, v1_device_platform=None, v2_device_platform=None):
@@ -494,10 +994,14 @@ def version_cmp(op, v1, v2, v1_device_platform=None, v2_device_platform=None):
 
     '''
     if isinstance(v1, str):
-        v1 = ClientVersion(v1, device_platform=v1_device_platform)
+        v1 = version_key(v1, device_platform=v1_device_platform)
+    elif isinstance(v1, ClientVersion):
+        v1 = v1.key
 
     if isinstance(v2, str):
-        v2 = ClientVersion(v2, device_platform=v2_device_platform)
+        v2 = version_key(v2, device_platform=v2_device_platform)
+    elif isinstance(v2, ClientVersion):
+        v2 = v2.key
 
     return op(v1, v2)
 
@@ -528,7 +1032,7 @@ def version_lt(v1, v2, v1_device_platform=None, v2_device_platform=None):
 
 
 def bearychat(body, channel='自动报警', markdown=None, attachments=None):
-    url = "https://hook.bearychat.com/=bw53H/incoming/e5d24a56bcc5b2ff23ab59bfc76ea465"
+    # delivered in the background by alert.bearychat_dispatcher
     payload = {
         'text': body,
         'markdown': markdown,
@@ -536,7 +1040,7 @@ def bearychat(body, channel='自动报警', markdown=None, attachments=None):
         'attachments': attachments,
     }
     data = dict((k, v) for k, v in payload.items() if v is not None)
-    requests.post(url, json=data)
+    return alert.bearychat_dispatcher.send(data)
 
 
 def amount_to_cent(amount):
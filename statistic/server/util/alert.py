@@ -0,0 +1,153 @@
+# statistic/server/util/alert.py
+
+
+import collections
+import os
+import queue
+import threading
+import time
+
+import requests
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BEARYCHAT_URL = "https://hook.bearychat.com/=bw53H/incoming/e5d24a56bcc5b2ff23ab59bfc76ea465"
+
+
+class AlertDispatcher(object):
+    '''
+    Posts alert payloads to the webhook `url` from a background thread, so
+    send() never waits on the network.
+
+    - at most `maxsize` alerts wait in the queue, further ones are dropped
+    - an alert with the same channel and text as one sent less than
+      `coalesce_window` seconds ago is only counted, the count is attached
+      to the next one that goes out
+    - at most `rate_limit` posts go out per `rate_period` seconds
+    - failed posts are retried `retries` times, waiting backoff * 2 ** n
+    '''
+
+    def __init__(self, url, maxsize=1000, timeout=5, retries=3, backoff=1.,
+                 coalesce_window=60, rate_limit=20, rate_period=60):
+        self.url = url
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce_window = coalesce_window
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_sent = {}
+        self._suppressed = collections.Counter()
+
+    def _ensure_worker(self):
+        # threads do not survive a fork, every uwsgi worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.maxsize)
+            self._session = requests.Session()
+            self._sent_at = collections.deque()
+            thread = threading.Thread(target=self._run, name='alert-dispatcher')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def send(self, payload):
+        '''Queue `payload`; returns False when it was coalesced or dropped.'''
+        key = (payload.get('channel'), payload.get('text'))
+        now = time.time()
+        with self._lock:
+            last = self._last_sent.get(key)
+            if last is not None and now - last < self.coalesce_window:
+                self._suppressed[key] += 1
+                return False
+            self._last_sent[key] = now
+            suppressed = self._suppressed.pop(key, 0)
+            if len(self._last_sent) > self.maxsize:
+                self._forget_before(now - self.coalesce_window)
+
+        if suppressed:
+            payload = dict(payload, text='%s (+%d similar)' % (payload.get('text'), suppressed))
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            logger.warning('alert queue is full, dropping %r', payload.get('text'))
+            with self._lock:
+                # nothing went out: the next duplicate is sent, counting this one too
+                if last is None:
+                    self._last_sent.pop(key, None)
+                else:
+                    self._last_sent[key] = last
+                self._suppressed[key] += suppressed + 1
+            return False
+        return True
+
+    def _forget_before(self, t):
+        for key, last in list(self._last_sent.items()):
+            if last < t and key not in self._suppressed:
+                del self._last_sent[key]
+
+    def flush(self, timeout=None):
+        '''Wait until every queued alert was handled; returns False on timeout.'''
+        if self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self._wait_for_rate_limit()
+                self._post(payload)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _wait_for_rate_limit(self):
+        sent_at = self._sent_at
+        while len(sent_at) >= self.rate_limit:
+            wait = sent_at[0] + self.rate_period - time.time()
+            if wait <= 0:
+                sent_at.popleft()
+            else:
+                time.sleep(wait)
+        sent_at.append(time.time())
+
+    def _post(self, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.post(self.url, json=payload, timeout=self.timeout)
+                if response.status_code < 500 and response.status_code != 429:
+                    if response.status_code >= 400:
+                        logger.warning('alert rejected with %s: %r', response.status_code, payload.get('text'))
+                    return response.status_code < 400
+                error = 'status %s' % response.status_code
+            except requests.RequestException as e:
+                error = repr(e)
+
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        logger.warning('alert not delivered after %s attempts (%s): %r', self.retries + 1, error, payload.get('text'))
+        return False
+
+
+bearychat_dispatcher = AlertDispatcher(BEARYCHAT_URL)
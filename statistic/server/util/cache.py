@@ -0,0 +1,101 @@
+# statistic/server/util/cache.py
+
+
+import collections
+import itertools
+import pickle
+import re
+import threading
+import time
+
+
+class LRUCache(object):
+    '''
+    Thread-safe in-process cache keeping the `maxsize` most recently used
+    entries, each for at most `ttl` seconds (forever when `ttl` is None).
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.set('a', 1); cache.set('b', 2); cache.get('a')
+    1
+    >>> cache.set('c', 3); cache.get('b') is None
+    True
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= self.timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else self.timer() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(object):
+    '''
+    Cache shared between processes, stored in a redis-like `client` that
+    provides `get`, `setex`, `delete` and `scan_iter`. Values are pickled.
+    '''
+
+    # keys deleted per DEL while clearing
+    CLEAR_BATCH_SIZE = 500
+
+    def __init__(self, client, ttl=300, prefix='cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return default
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self.prefix + key, ttl or self.ttl, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        '''Delete every key under the prefix. SCAN walks the keyspace in
+        steps, so this does not block redis like KEYS would.'''
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefix) + '*'
+        keys = self.client.scan_iter(match=pattern, count=self.CLEAR_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(keys, self.CLEAR_BATCH_SIZE))
+            if not batch:
+                break
+            self.client.delete(*batch)
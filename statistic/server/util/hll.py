@@ -0,0 +1,132 @@
+# statistic/server/util/hll.py
+
+
+import collections
+import hashlib
+import math
+import zlib
+
+from statistic.server.util import optional_import
+
+# 2 ** 12 registers: about 1.6% standard error in 4 KiB, less once compressed
+DEFAULT_PRECISION = 12
+
+_RAW, _ZLIB = 0, 1
+
+_INVERSE_POWERS = [2.0 ** -r for r in range(66)]
+
+
+def _hash64(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+class HyperLogLog(object):
+    '''
+    Approximate count of distinct values in 2 ** p one-byte registers.
+    Sketches of the same precision merge into the sketch of the union.
+
+    >>> a, b = HyperLogLog(), HyperLogLog()
+    >>> a.update('device-%d' % i for i in range(1000))
+    >>> b.update('device-%d' % i for i in range(500, 1500))
+    >>> 1450 < HyperLogLog.union([a, b]).count() < 1550
+    True
+    >>> HyperLogLog.from_bytes(a.to_bytes()) == a
+    True
+    '''
+
+    def __init__(self, p=DEFAULT_PRECISION, registers=None):
+        if not 4 <= p <= 16:
+            raise ValueError('precision must be between 4 and 16, not %r' % p)
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m) if registers is None else bytearray(registers)
+        if len(self.registers) != self.m:
+            raise ValueError('%d registers expected, got %d' % (self.m, len(self.registers)))
+
+    def add(self, value):
+        x = _hash64(value)
+        bits = 64 - self.p
+        index = x >> bits
+        # position of the first 1 bit in the remaining bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        '''Fold `other` into this sketch, which then counts the union.'''
+        if other.p != self.p:
+            raise ValueError('cannot merge sketches of precision %d and %d' % (self.p, other.p))
+        numpy = optional_import('numpy')
+        if numpy is not None:
+            registers = numpy.frombuffer(self.registers, dtype=numpy.uint8)
+            numpy.maximum(registers, numpy.frombuffer(other.registers, dtype=numpy.uint8), out=registers)
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    @classmethod
+    def union(cls, sketches, p=DEFAULT_PRECISION):
+        result = None
+        for sketch in sketches:
+            if result is None:
+                result = cls(sketch.p, sketch.registers)
+            else:
+                result.merge(sketch)
+        return result if result is not None else cls(p)
+
+    def count(self):
+        m = self.m
+        histogram = collections.Counter(self.registers)
+        estimate = self._alpha() * m * m / sum(n * _INVERSE_POWERS[r] for r, n in histogram.items())
+        zeros = histogram.get(0, 0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is far better for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def _alpha(self):
+        if self.m == 16:
+            return 0.673
+        if self.m == 32:
+            return 0.697
+        if self.m == 64:
+            return 0.709
+        return 0.7213 / (1 + 1.079 / self.m)
+
+    def to_bytes(self):
+        '''Format byte, precision byte and the registers, zlib compressed when
+        that is smaller, as it is for all but the busiest days.'''
+        raw = bytes(self.registers)
+        compressed = zlib.compress(raw, 1)
+        if len(compressed) < len(raw):
+            return bytes([_ZLIB, self.p]) + compressed
+        return bytes([_RAW, self.p]) + raw
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        if len(data) < 2 or data[0] not in (_RAW, _ZLIB):
+            raise ValueError('not a serialized HyperLogLog')
+        registers = data[2:]
+        if data[0] == _ZLIB:
+            try:
+                registers = zlib.decompress(registers)
+            except zlib.error as e:
+                raise ValueError('corrupt HyperLogLog: %s' % e)
+        return cls(data[1], registers)
+
+    def __eq__(self, other):
+        return isinstance(other, HyperLogLog) and self.p == other.p and self.registers == other.registers
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<HyperLogLog(p=%d, count~%d)>' % (self.p, self.count())
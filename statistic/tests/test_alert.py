@@ -0,0 +1,92 @@
+# statistic/tests/test_alert.py
+
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from statistic.server.util.alert import AlertDispatcher
+
+
+class StubWebhook(BaseHTTPRequestHandler):
+    # answers with the next queued status, 200 once they run out
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(json.loads(body.decode('utf-8')))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAlertDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubWebhook)
+        self.server.received, self.server.statuses, self.server.delay = [], [], 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%s/hook' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_send_does_not_wait_for_the_webhook(self):
+        self.server.delay = 0.5
+        dispatcher = AlertDispatcher(self.url)
+        started = time.time()
+        self.assertTrue(dispatcher.send({'text': 'db down'}))
+        self.assertLess(time.time() - started, 0.1)
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual(self.server.received, [{'text': 'db down'}])
+
+    def test_duplicates_are_coalesced(self):
+        dispatcher = AlertDispatcher(self.url, coalesce_window=0.2)
+        self.assertTrue(dispatcher.send({'text': 'slow'}))
+        self.assertFalse(dispatcher.send({'text': 'slow'}))
+        self.assertFalse(dispatcher.send({'text': 'slow'}))
+        time.sleep(0.3)
+        self.assertTrue(dispatcher.send({'text': 'slow'}))
+        dispatcher.flush(timeout=5)
+        self.assertEqual([p['text'] for p in self.server.received], ['slow', 'slow (+2 similar)'])
+
+    def test_dropped_alerts_are_not_coalesced(self):
+        self.server.delay = 0.3
+        dispatcher = AlertDispatcher(self.url, maxsize=1)
+        dispatcher.send({'text': 'busy'})
+        time.sleep(0.1)
+        self.assertTrue(dispatcher.send({'text': 'queued'}))
+        self.assertFalse(dispatcher.send({'text': 'full'}))
+        self.assertFalse(dispatcher.send({'text': 'full'}))
+        dispatcher.flush(timeout=5)
+        self.assertTrue(dispatcher.send({'text': 'full'}))
+        dispatcher.flush(timeout=5)
+        self.assertEqual([p['text'] for p in self.server.received], ['busy', 'queued', 'full (+2 similar)'])
+
+    def test_server_errors_are_retried(self):
+        self.server.statuses = [500, 503]
+        dispatcher = AlertDispatcher(self.url, retries=3, backoff=0.01)
+        dispatcher.send({'text': 'flaky'})
+        dispatcher.flush(timeout=5)
+        self.assertEqual(len(self.server.received), 3)
+
+    def test_rate_limit(self):
+        dispatcher = AlertDispatcher(self.url, rate_limit=2, rate_period=0.5)
+        started = time.time()
+        for i in range(3):
+            dispatcher.send({'text': 'alert %d' % i})
+        dispatcher.flush(timeout=5)
+        self.assertEqual(len(self.server.received), 3)
+        self.assertGreaterEqual(time.time() - started, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# statistic/tests/test_bulk_upsert.py
+
+
+import datetime
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from statistic.tests.base import BaseTestCase
+from statistic.server.models import db, ChannelStatistic
+
+
+DAY = datetime.date(2016, 1, 4)
+CHANNEL = 'test-bulk-upsert'
+
+
+def row(n, day=DAY, channel_name=CHANNEL):
+    return dict(date=day, channel_name=channel_name, registered_num=n)
+
+
+class TestBulkUpsert(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def registered_num(self, day=DAY):
+        return db.session.query(ChannelStatistic.registered_num) \
+            .filter_by(date=day, channel_name=CHANNEL).scalar()
+
+    def test_counts(self):
+        self.assertEqual(ChannelStatistic.bulk_upsert([row(1), row(2, day=DAY + datetime.timedelta(1))]), (2, 0))
+        self.assertEqual(ChannelStatistic.bulk_upsert([row(5), row(3, day=DAY + datetime.timedelta(2))]), (1, 1))
+        self.assertEqual(self.registered_num(), 5)
+
+    def test_duplicate_keys_collapse(self):
+        # small batches: duplicates in one statement and across statements
+        self.assertEqual(ChannelStatistic.bulk_upsert([row(1), row(2), row(3)], batch_size=2), (1, 1))
+        self.assertEqual(self.registered_num(), 3)
+
+    def test_increment(self):
+        ChannelStatistic.bulk_upsert([row(1)])
+        ChannelStatistic.bulk_upsert([row(2), row(3)], increment_columns=['registered_num'])
+        self.assertEqual(self.registered_num(), 6)
+
+    def test_updates_invalidate_cache(self):
+        ChannelStatistic.bulk_upsert([row(1)])
+        oid = db.session.query(ChannelStatistic.id).filter_by(date=DAY, channel_name=CHANNEL).scalar()
+        self.assertEqual(ChannelStatistic.get(oid).registered_num, 1)
+        db.session.expunge_all()
+
+        ChannelStatistic.bulk_upsert([row(2)], increment_columns=['registered_num'])
+        self.assertEqual(ChannelStatistic.get(oid).registered_num, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
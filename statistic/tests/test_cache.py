@@ -0,0 +1,89 @@
+# statistic/tests/test_cache.py
+
+
+import re
+import unittest
+
+from statistic.server.util.cache import LRUCache, RedisCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis(object):
+    # local stand-in for the redis client behind RedisCache
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match='*', count=None):
+        # redis globs: * and ? wildcards, backslash escapes
+        regex = ''.join('.*' if token == '*' else '.' if token == '?' else re.escape(token[-1])
+                        for token in re.findall(r'\\.|.', match))
+        return iter([key for key in list(self.data) if re.match(regex + '$', key)])
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_entries_expire_after_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, timer=clock)
+        cache.set('user:1', {'id': 1})
+        clock.now = 9
+        self.assertEqual(cache.get('user:1'), {'id': 1})
+        clock.now = 10
+        self.assertIsNone(cache.get('user:1'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_delete(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a', 'missing')
+        self.assertEqual(len(cache), 0)
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def test_roundtrip_and_delete(self):
+        cache = RedisCache(FakeRedis())
+        cache.set('user:1', {'email': 'ad@min.com'})
+        self.assertEqual(cache.get('user:1'), {'email': 'ad@min.com'})
+        cache.delete('user:1')
+        self.assertEqual(cache.get('user:1', 'missing'), 'missing')
+
+    def test_clear_only_touches_prefix(self):
+        client = FakeRedis()
+        client.setex('other:1', 60, b'x')
+        cache = RedisCache(client, prefix='cache[1]:')
+        cache.CLEAR_BATCH_SIZE = 2
+        for i in range(5):
+            cache.set('user:%d' % i, i)
+        cache.clear()
+        self.assertEqual(list(client.data), ['other:1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
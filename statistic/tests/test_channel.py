@@ -0,0 +1,54 @@
+# statistic/tests/test_channel.py
+
+
+import datetime
+import unittest
+
+from statistic.server.logic.channel import activated_value, split_range
+from statistic.server.logic.rollup import week_bucket, month_bucket
+
+
+D = datetime.date
+
+
+class TestSplitRange(unittest.TestCase):
+
+    def test_whole_buckets(self):
+        # 2016-01-04 is a monday
+        self.assertEqual(split_range(D(2016, 1, 4), D(2016, 1, 17), week_bucket),
+                         ((D(2016, 1, 4), D(2016, 1, 18)), []))
+
+    def test_clipped_edges(self):
+        self.assertEqual(split_range(D(2016, 1, 6), D(2016, 3, 10), month_bucket),
+                         ((D(2016, 2, 1), D(2016, 3, 1)),
+                          [(D(2016, 1, 6), D(2016, 2, 1)), (D(2016, 3, 1), D(2016, 3, 11))]))
+
+    def test_inside_one_bucket(self):
+        self.assertEqual(split_range(D(2016, 1, 4), D(2016, 1, 6), week_bucket),
+                         ((None, None), [(D(2016, 1, 4), D(2016, 1, 7))]))
+
+    def test_two_clipped_buckets(self):
+        self.assertEqual(split_range(D(2016, 1, 6), D(2016, 1, 13), week_bucket),
+                         ((None, None), [(D(2016, 1, 6), D(2016, 1, 11)), (D(2016, 1, 11), D(2016, 1, 14))]))
+        # clipped at one end only
+        self.assertEqual(split_range(D(2016, 1, 4), D(2016, 1, 6), week_bucket),
+                         ((None, None), [(D(2016, 1, 4), D(2016, 1, 7))]))
+        self.assertEqual(split_range(D(2016, 1, 6), D(2016, 1, 10), week_bucket),
+                         ((None, None), [(D(2016, 1, 6), D(2016, 1, 11))]))
+
+    def test_open_ended(self):
+        self.assertEqual(split_range(None, D(2016, 1, 6), week_bucket),
+                         ((None, D(2016, 1, 4)), [(D(2016, 1, 4), D(2016, 1, 7))]))
+        self.assertEqual(split_range(None, None, week_bucket), ((None, None), []))
+
+
+class TestActivatedValue(unittest.TestCase):
+
+    def test_keeps_fractions(self):
+        self.assertEqual(activated_value(17 * 0.5), 8.5)
+        self.assertEqual(activated_value(3 * 0.3333), 1.0)
+        self.assertEqual(activated_value(7), 7.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# statistic/tests/test_cursor.py
+
+
+import base64
+import datetime
+import json
+import unittest
+
+from statistic.server.models import ChannelStatistic
+
+
+def raw_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+
+class TestCursor(unittest.TestCase):
+
+    def test_roundtrip(self):
+        row = ChannelStatistic(id=7, date=datetime.date(2016, 1, 4))
+        cursor = ChannelStatistic.encode_cursor('date', row)
+        self.assertEqual(ChannelStatistic.decode_cursor('date', cursor), (datetime.date(2016, 1, 4), 7))
+
+    def test_tampered(self):
+        for cursor in ('not base64!', raw_cursor(5), raw_cursor({'a': 1, 'b': 2}),
+                       raw_cursor(['2016-01-04']), raw_cursor([5, 7]),
+                       raw_cursor(['2016-01-04', '7']), raw_cursor(['2016-01-04', True]),
+                       raw_cursor(['2016-01-04', 2 ** 40]), raw_cursor(['someday', 7])):
+            self.assertRaises(ValueError, ChannelStatistic.decode_cursor, 'date', cursor)
+        self.assertRaises(ValueError, ChannelStatistic.decode_cursor, 'registered_num', raw_cursor(['5', 7]))
+
+    def test_page_size(self):
+        for num in (0, -1):
+            self.assertRaises(ValueError, ChannelStatistic.list, 'date', num)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# statistic/tests/test_hll.py
+
+
+import unittest
+
+from statistic.server.util.hll import HyperLogLog
+
+
+def sketch_of(values):
+    sketch = HyperLogLog()
+    sketch.update(values)
+    return sketch
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def assertAbout(self, estimate, exact, error=0.05):
+        self.assertLessEqual(abs(estimate - exact), exact * error, (estimate, exact))
+
+    def test_small_counts(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+        self.assertEqual(sketch_of(['a', 'a', 'b']).count(), 2)
+        self.assertAbout(sketch_of(range(100)).count(), 100)
+
+    def test_large_counts(self):
+        for n in (1000, 20000, 200000):
+            self.assertAbout(sketch_of('device-%d' % i for i in range(n)).count(), n)
+
+    def test_union(self):
+        a = sketch_of(range(0, 30000))
+        b = sketch_of(range(20000, 50000))
+        union = HyperLogLog.union([a, b])
+        self.assertAbout(union.count(), 50000)
+        # the union does not touch its inputs, merge folds in place
+        self.assertEqual(a, sketch_of(range(0, 30000)))
+        self.assertEqual(a.merge(b), union)
+        self.assertEqual(HyperLogLog.union([]).count(), 0)
+
+    def test_precision_mismatch(self):
+        self.assertRaises(ValueError, HyperLogLog(10).merge, HyperLogLog(12))
+        self.assertRaises(ValueError, HyperLogLog, 3)
+
+    def test_serialization(self):
+        for sketch in (HyperLogLog(), sketch_of(range(10)), sketch_of(range(100000))):
+            data = sketch.to_bytes()
+            self.assertLessEqual(len(data), 2 + sketch.m)
+            self.assertEqual(HyperLogLog.from_bytes(data), sketch)
+        self.assertRaises(ValueError, HyperLogLog.from_bytes, b'\x07\x0c')
+        self.assertRaises(ValueError, HyperLogLog.from_bytes, b'\x01\x0cnot zlib')
+        # well-formed, but the registers do not match the precision
+        self.assertRaises(ValueError, HyperLogLog.from_bytes, b'\x00\x0c\x00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# statistic/tests/test_increment.py
+
+
+import datetime
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from statistic.tests.base import BaseTestCase
+from statistic.server.models import db, ChannelStatistic
+
+
+DAY = datetime.date(2016, 1, 4)
+
+
+class TestIncrement(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+        self.row = ChannelStatistic.create(date=DAY, channel_name='test-increment', registered_num=1)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def registered_num(self):
+        return db.session.query(ChannelStatistic.registered_num).filter_by(id=self.row.id).scalar()
+
+    def test_inc_returns_numbers(self):
+        self.assertEqual(self.row.inc('registered_num', 2).registered_num, 3)
+        self.assertEqual(self.row.dec('registered_num').registered_num, 2)
+        self.assertEqual(ChannelStatistic(registered_num=1).inc('registered_num').registered_num, 2)
+
+    def test_inc_is_server_side(self):
+        self.row.inc('registered_num', 2).inc('registered_num')
+        # a concurrent writer, not seen by the session
+        ChannelStatistic.increment('registered_num', 10, id=self.row.id)
+        db.session.flush()
+        self.assertEqual(self.registered_num(), 14)
+
+    def test_increment_many(self):
+        n = ChannelStatistic.increment_many('registered_num', [
+            dict(date=DAY, channel_name='test-increment', registered_num=2),
+            dict(date=DAY, channel_name='test-increment', registered_num=3),
+            dict(date=DAY, channel_name='test-increment-missing', registered_num=3),
+        ])
+        self.assertEqual(n, 1)
+        self.assertEqual(self.registered_num(), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# statistic/tests/test_indexes.py
+
+
+import contextlib
+import hashlib
+import unittest
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from statistic.tests.base import BaseTestCase
+from statistic.server.admin.views import ChannelStatisticView, UsersView
+from statistic.server.models import db, User, ChannelStatistic
+
+
+N_CHANNELS = 1000
+N_ROWS = 20000
+N_USERS = 5000
+
+SEED_SQL = [
+    '''
+    INSERT INTO channel_statistic (created_on, updated_on, channel_name, date, registered_num, factor)
+    SELECT now(), now(), 'ch-' || md5(mod(i, {channels})::text), DATE '2016-01-01' + i / {channels}, i, 1
+    FROM generate_series(1, {rows}) AS i
+    '''.format(channels=N_CHANNELS, rows=N_ROWS),
+    '''
+    INSERT INTO users (created_on, updated_on, email, password, is_admin, channel_name,
+                       show_date_begin_limit, show_date_end_limit)
+    SELECT now(), now(), md5(i::text) || '@test-indexes.com', 'x', false, 'ch-' || md5(mod(i, {channels})::text),
+           DATE '2016-01-01', DATE '2016-12-31'
+    FROM generate_series(1, {users}) AS i
+    '''.format(channels=N_CHANNELS, users=N_USERS),
+    'ANALYZE channel_statistic',
+    'ANALYZE users',
+]
+
+
+def channel(i):
+    return 'ch-' + hashlib.md5(str(i).encode('ascii')).hexdigest()
+
+
+class TestAdminListPlans(BaseTestCase):
+    # plans of the queries the admin list views issue, over enough seeded
+    # rows that the planner only picks an index where it actually pays off;
+    # the seed is rolled back again
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+        for sql in SEED_SQL:
+            db.session.execute(sql)
+        self.channel_view = ChannelStatisticView(ChannelStatistic, db.session)
+        self.users_view = UsersView(User, db.session)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def filter_arg(self, view, column, filter_class, value):
+        for idx, flt in enumerate(view._filters):
+            if flt.column.key == column and type(flt).__name__ == filter_class:
+                return idx, flt.name, value
+        raise LookupError('%s has no %s on %s' % (type(view).__name__, filter_class, column))
+
+    def list_query(self, view, search=None, filters=()):
+        _, query = view.get_list(0, None, False, search, list(filters), execute=False)
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        return str(compiled), compiled.params
+
+    @contextlib.contextmanager
+    def issued_queries(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+    def plan(self, statement, params):
+        rows = db.session.connection().execute('EXPLAIN ' + statement, params)
+        return '\n'.join(row[0] for row in rows)
+
+    def assertUsesIndex(self, statement_and_params, index):
+        plan = self.plan(*statement_and_params)
+        self.assertIn(index, plan, plan)
+
+    def test_channel_filter(self):
+        flt = self.filter_arg(self.channel_view, 'channel_name', 'FilterEqual', channel(42))
+        self.assertUsesIndex(self.list_query(self.channel_view, filters=[flt]),
+                             'ix_channel_statistic_channel_name_date_updated')
+
+    def test_channel_search(self):
+        self.assertUsesIndex(self.list_query(self.channel_view, search=channel(42)[3:12]),
+                             'ix_channel_statistic_channel_name_trgm')
+
+    def test_keyset_page(self):
+        _, items = self.channel_view.get_list(0, None, False, None, [])
+        cursor = ChannelStatistic.encode_cursor('date', items[-1])
+        with self.app.test_request_context('/admin/channelstatistic/?page=1&cursor=' + cursor):
+            with self.issued_queries() as statements:
+                self.channel_view.get_list(1, None, False, None, [])
+        page_queries = [(s, p) for s, p in statements
+                        if s.lstrip().upper().startswith('SELECT') and 'LIMIT' in s.upper()]
+        self.assertTrue(page_queries, statements)
+        for statement_and_params in page_queries:
+            self.assertUsesIndex(statement_and_params, 'ix_channel_statistic_date_id')
+
+    def test_user_searches(self):
+        self.assertUsesIndex(self.list_query(self.users_view, search=hashlib.md5(b'42').hexdigest()[:10]),
+                             'ix_users_email_trgm')
+        flt = self.filter_arg(self.users_view, 'channel_name', 'FilterLike', channel(42)[3:12])
+        self.assertUsesIndex(self.list_query(self.users_view, filters=[flt]),
+                             'ix_users_channel_name_trgm')
+
+
+if __name__ == '__main__':
+    unittest.main()
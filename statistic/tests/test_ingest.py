@@ -0,0 +1,191 @@
+# statistic/tests/test_ingest.py
+
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from statistic.tests.base import BaseTestCase
+from statistic.server.logic import ingest
+from statistic.server.logic.ingest import parse_event, RegistrationAggregator, ingest_spool
+from statistic.server.models import db, ChannelStatistic, ChannelDeviceSketch
+
+
+DAY = datetime.date(2016, 1, 4)
+CHANNEL = 'test-ingest'
+
+
+def event(**kwargs):
+    return dict(dict(channel_name=CHANNEL, ts='2016-01-04 10:00:00+08:00'), **kwargs)
+
+
+class TestRegistrationEvents(unittest.TestCase):
+
+    def test_partner_day(self):
+        # 16:30 utc is already the next day in Asia/Shanghai
+        self.assertEqual(parse_event({'channel_name': 'appstore', 'ts': '2016-01-04T16:30:00Z'}),
+                         (datetime.date(2016, 1, 5), 'appstore', 1))
+        self.assertEqual(parse_event({'channel_name': 'appstore', 'ts': '2016-01-04 16:30:00+08:00', 'count': 3}),
+                         (datetime.date(2016, 1, 4), 'appstore', 3))
+
+    def test_bad_events(self):
+        for event in ({'ts': '2016-01-04'},
+                      {'channel_name': 'appstore', 'ts': 'yesterday'},
+                      {'channel_name': 'appstore', 'ts': '2016-01-04', 'count': 0},
+                      {'channel_name': 'appstore', 'ts': '2016-01-04', 'count': 10 ** 12},
+                      {'channel_name': 'appstore', 'ts': '2016-01-04', 'count': 2.7},
+                      {'channel_name': 'appstore', 'ts': '2016-01-04', 'count': '3'},
+                      {'channel_name': 'appstore', 'ts': '2016-01-04', 'count': True},
+                      {'channel_name': '', 'ts': '2016-01-04'},
+                      'appstore'):
+            self.assertRaises(ValueError, parse_event, event)
+
+    def test_counts_per_key(self):
+        aggregator = RegistrationAggregator()
+        accepted, rejected = aggregator.add([
+            {'channel_name': 'appstore', 'ts': '2016-01-04 10:00:00+08:00'},
+            {'channel_name': 'appstore', 'ts': '2016-01-04 11:00:00+08:00', 'count': 2},
+            {'channel_name': 'wandoujia', 'ts': '2016-01-04 11:00:00+08:00'},
+            {'channel_name': 'appstore'},
+        ], background=False)
+        self.assertEqual((accepted, rejected), (3, 1))
+        self.assertEqual(aggregator.pending(), 2)
+        self.assertEqual(aggregator._pending[(datetime.date(2016, 1, 4), 'appstore')], 3)
+
+    def test_device_sketches(self):
+        aggregator = RegistrationAggregator()
+        aggregator.add([
+            {'channel_name': 'appstore', 'ts': '2016-01-04 10:00:00+08:00', 'device_id': 'a'},
+            {'channel_name': 'appstore', 'ts': '2016-01-04 11:00:00+08:00', 'device_id': 'a'},
+            {'channel_name': 'appstore', 'ts': '2016-01-04 12:00:00+08:00'},
+        ], background=False, default_device_id='b')
+        self.assertEqual(aggregator._sketches[(datetime.date(2016, 1, 4), 'appstore')].count(), 2)
+
+    def test_pending_count_stays_in_range(self):
+        aggregator = RegistrationAggregator()
+        aggregator._pending[(DAY, CHANNEL)] = ingest.MAX_PENDING_COUNT
+        with self.assertLogs('statistic.server.logic.ingest.dead_letter', 'ERROR'):
+            aggregator.add([event()], background=False)
+        self.assertEqual(aggregator._pending[(DAY, CHANNEL)], ingest.MAX_PENDING_COUNT)
+
+
+class TestFailedFlush(unittest.TestCase):
+
+    def setUp(self):
+        self.bulk_upsert = mock.Mock(side_effect=RuntimeError('integer out of range'))
+        for patcher in (mock.patch.object(ingest, 'db'),
+                        mock.patch.object(ingest.ChannelStatistic, 'bulk_upsert', self.bulk_upsert),
+                        mock.patch.object(ingest.ChannelDeviceSketch, 'merge_sketches')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_counts_are_put_back(self):
+        aggregator = RegistrationAggregator()
+        aggregator.add([event(count=2, device_id='a')], background=False)
+        self.assertRaises(RuntimeError, aggregator.flush)
+        self.assertEqual(aggregator._pending[(DAY, CHANNEL)], 2)
+        self.assertEqual(aggregator._sketches[(DAY, CHANNEL)].count(), 1)
+        ingest.db.session.rollback.assert_called_once_with()
+
+    def test_failing_key_is_dead_lettered(self):
+        aggregator = RegistrationAggregator()
+        aggregator.add([event(count=2)], background=False)
+        for _ in range(ingest.FLUSH_MAX_ATTEMPTS - 1):
+            self.assertRaises(RuntimeError, aggregator.flush)
+        with self.assertLogs('statistic.server.logic.ingest.dead_letter', 'ERROR') as logs:
+            self.assertRaises(RuntimeError, aggregator.flush)
+        self.assertEqual([json.loads(record.getMessage()) for record in logs.records],
+                         [dict(channel_name=CHANNEL, ts='2016-01-04', count=2)])
+        self.assertEqual(aggregator.pending(), 0)
+
+        # later windows are written again
+        self.bulk_upsert.side_effect = None
+        aggregator.add([event(channel_name='test-ingest-other')], background=False)
+        self.assertEqual(aggregator.flush(), 1)
+
+
+class TestFlush(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+        # keep everything in the transaction tearDown rolls back
+        patcher = mock.patch.object(db.session, 'commit', db.session.flush)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def registered_num(self):
+        return db.session.query(ChannelStatistic.registered_num).filter_by(date=DAY, channel_name=CHANNEL).scalar()
+
+    def devices(self):
+        return ChannelDeviceSketch.query.filter_by(date=DAY, channel_name=CHANNEL).one().hll.count()
+
+    def test_counts_are_added(self):
+        ChannelStatistic.create(date=DAY, channel_name=CHANNEL, registered_num=5)
+        aggregator = RegistrationAggregator()
+        aggregator.add([event(device_id='a'), event(count=2, device_id='b')], background=False)
+        self.assertEqual(aggregator.flush(), 1)
+        # a concurrent writer, not seen by the aggregator
+        ChannelStatistic.increment('registered_num', 10, date=DAY, channel_name=CHANNEL)
+        aggregator.add([event(device_id='a'), event(device_id='c')], background=False)
+        aggregator.flush()
+        self.assertEqual(self.registered_num(), 20)
+        self.assertEqual(self.devices(), 3)
+        self.assertEqual(aggregator.pending(), 0)
+
+    def test_spool(self):
+        path = os.path.join(self.tmpdir, 'registrations.json')
+        with open(path, 'w') as f:
+            f.write('\n'.join([json.dumps(event()), json.dumps(event(count=3)), '{not json', '',
+                               json.dumps(event(count=0))]))
+        self.assertEqual(ingest_spool(path), (2, 2))
+        self.assertEqual(self.registered_num(), 4)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + '.done'))
+
+
+class TestIngestRoute(BaseTestCase):
+
+    def setUp(self):
+        token = self.app.config.get('INGEST_TOKEN')
+        self.app.config['INGEST_TOKEN'] = 'secret'
+        self.addCleanup(self.app.config.__setitem__, 'INGEST_TOKEN', token)
+        self.aggregator = RegistrationAggregator()
+        for patcher in (mock.patch.object(ingest, 'registrations', self.aggregator),
+                        mock.patch.object(RegistrationAggregator, '_ensure_worker')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, payload, token='secret'):
+        return self.client.post('/ingest/registrations', data=json.dumps(payload), content_type='application/json',
+                                headers={'X-Ingest-Token': token})
+
+    def test_accepted(self):
+        response = self.post({'events': [event(), event(count=2), event(count=2.5)]})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json, dict(accepted=2, rejected=1))
+        self.assertEqual(self.aggregator._pending[(DAY, CHANNEL)], 3)
+
+    def test_bad_token(self):
+        self.assert403(self.post([event()], token='guess'))
+        self.assertEqual(self.aggregator.pending(), 0)
+
+    def test_not_a_list(self):
+        self.assert400(self.post({'events': event()}))
+
+
+if __name__ == '__main__':
+    unittest.main()
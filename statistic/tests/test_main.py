@@ -1,9 +1,18 @@
 # stat/server/tests/test_main.py
 
 
+import datetime
 import unittest
 
+from sqlalchemy.exc import OperationalError
+
 from statistic.tests.base import BaseTestCase
+from statistic.server.models import db, ChannelStatistic, ChannelDeviceSketch, User
+from statistic.server.util.hll import HyperLogLog
+
+
+D = datetime.date
+CHANNEL = 'test-csv'
 
 
 class TestMainBlueprint(BaseTestCase):
@@ -19,6 +28,97 @@ class TestMainBlueprint(BaseTestCase):
         self.assert404(response)
         self.assertTemplateUsed('errors/404.html')
 
+    def test_statistics_download_requires_login(self):
+        # Ensure anonymous users are sent to the login page.
+        response = self.client.get('/channel/statistics.csv')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.location)
+
+    def test_series_requires_login(self):
+        # Ensure anonymous users are sent to the login page.
+        response = self.client.get('/channel/series.json?granularity=week')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.location)
+
+    def test_devices_require_login(self):
+        # Ensure anonymous users are sent to the login page.
+        response = self.client.get('/channel/devices.json')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.location)
+
+    def test_revalidation_requires_login(self):
+        # Ensure a matching validator does not skip the login check.
+        response = self.client.get('/channel/statistics.csv', headers={'If-None-Match': '"x"'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_ingest_disabled_without_token(self):
+        # Ensure the ingest endpoint only exists once INGEST_TOKEN is set.
+        response = self.client.post('/ingest/registrations', data='[]', content_type='application/json')
+        self.assert404(response)
+
+
+class TestChannelStatistics(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+        for day, n, factor in ((D(2016, 1, 4), 17, .5), (D(2016, 1, 5), 3, 1), (D(2016, 1, 6), 1, .3333)):
+            ChannelStatistic.create(date=day, channel_name=CHANNEL, registered_num=n, factor=factor)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, is_admin=False, **kwargs):
+        user = User('csv-%s@user.com' % is_admin, 'secret', is_admin=is_admin)
+        for k, v in kwargs.items():
+            setattr(user, k, v)
+        db.session.add(user)
+        db.session.flush()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+
+    def test_streams_rows(self):
+        # Ensure the download has a header row and activated_num keeps its fraction.
+        self.login(is_admin=True)
+        response = self.client.get('/channel/statistics.csv?channel_name=%s&start_date=2016-01-04' % CHANNEL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.data.decode('utf-8').splitlines(), [
+            '"date","channel_name","activated_num"',
+            '"2016-01-04","test-csv","8.5"',
+            '"2016-01-05","test-csv","3.0"',
+            '"2016-01-06","test-csv","0.33"',
+        ])
+
+    def test_clipped_to_user_limits(self):
+        # Ensure users only download their own channel within their show_date limits.
+        self.login(channel_name=CHANNEL, show_date_begin_limit=D(2016, 1, 5), show_date_end_limit=D(2016, 1, 5))
+        response = self.client.get('/channel/statistics.csv?channel_name=other&start_date=2016-01-01')
+        self.assertEqual(response.data.decode('utf-8').splitlines(), [
+            '"date","channel_name","activated_num"',
+            '"2016-01-05","test-csv","3.0"',
+        ])
+
+    def test_devices_revalidation(self):
+        # Ensure the device counts carry validators and answer a matching revalidation with 304.
+        sketch = HyperLogLog()
+        sketch.update(['a', 'b'])
+        ChannelDeviceSketch.merge_sketches({(D(2016, 1, 4), CHANNEL): sketch})
+        self.login(is_admin=True)
+        url = '/channel/devices.json?channel_name=%s&start_date=2016-01-04&end_date=2016-01-31' % CHANNEL
+        response = self.client.get(url)
+        self.assertEqual(response.json['unique_devices'], 2)
+        etag = response.headers['ETag']
+        self.assert_status(self.client.get(url, headers={'If-None-Match': etag}), 304)
+
+        sketch.add('c')
+        ChannelDeviceSketch.merge_sketches({(D(2016, 1, 5), CHANNEL): sketch})
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(response)
+        self.assertEqual(response.json['unique_devices'], 3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+# statistic/tests/test_rollup.py
+
+
+import datetime
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from statistic.tests.base import BaseTestCase
+from statistic.server.logic import rollup
+from statistic.server.models import db, ChannelStatistic, ChannelStatisticWeekly, ChannelStatisticMonthly
+
+
+D = datetime.date
+CHANNEL = 'test-rollup'
+OTHER_CHANNEL = 'test-rollup-other'
+
+
+class TestRollup(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def refresh(self):
+        # what a commit runs, without committing
+        rollup._refresh_before_commit(db.session)
+
+    def weeks(self, channel_name=CHANNEL):
+        return dict(db.session.query(ChannelStatisticWeekly.period_start, ChannelStatisticWeekly.registered_num)
+                    .filter_by(channel_name=channel_name))
+
+    def test_sums_per_bucket(self):
+        # 2016-01-04 and 2016-01-11 are mondays
+        for day, n in ((D(2016, 1, 4), 1), (D(2016, 1, 10), 2), (D(2016, 1, 11), 4)):
+            ChannelStatistic.create(date=day, channel_name=CHANNEL, registered_num=n, factor=.5)
+        self.refresh()
+        self.assertEqual(self.weeks(), {D(2016, 1, 4): 3, D(2016, 1, 11): 4})
+        month = ChannelStatisticMonthly.query.filter_by(channel_name=CHANNEL).one()
+        self.assertEqual((month.period_start, month.registered_num, month.activated_num), (D(2016, 1, 1), 7, 3.5))
+
+    def test_row_moves_date(self):
+        row = ChannelStatistic.create(date=D(2016, 1, 4), channel_name=CHANNEL, registered_num=1)
+        ChannelStatistic.create(date=D(2016, 1, 5), channel_name=CHANNEL, registered_num=2)
+        self.refresh()
+        row.date = D(2016, 1, 11)
+        self.refresh()
+        # the old bucket loses the row, the new one gains it
+        self.assertEqual(self.weeks(), {D(2016, 1, 4): 2, D(2016, 1, 11): 1})
+
+    def test_row_moves_channel(self):
+        row = ChannelStatistic.create(date=D(2016, 1, 4), channel_name=CHANNEL, registered_num=1)
+        self.refresh()
+        row.channel_name = OTHER_CHANNEL
+        self.refresh()
+        # the emptied bucket is removed
+        self.assertEqual(self.weeks(), {})
+        self.assertEqual(self.weeks(OTHER_CHANNEL), {D(2016, 1, 4): 1})
+
+    def test_deleted_row_empties_bucket(self):
+        row = ChannelStatistic.create(date=D(2016, 1, 4), channel_name=CHANNEL, registered_num=1)
+        self.refresh()
+        db.session.delete(row)
+        self.refresh()
+        self.assertEqual(self.weeks(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
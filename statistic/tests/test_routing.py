@@ -0,0 +1,132 @@
+# statistic/tests/test_routing.py
+
+
+import unittest
+
+from flask import Flask
+from sqlalchemy import table, column, select
+
+from statistic.server.routing import Replica, ReplicaPool, RoutingSQLAlchemy
+
+
+REPLICA = object()
+
+items = table('items', column('id'))
+
+
+class StubPool(object):
+
+    def choose(self):
+        return REPLICA
+
+
+class StubConnection(object):
+
+    def __init__(self, version, lag):
+        self.dialect = type('Dialect', (object,), {'server_version_info': version})()
+        self.lag = lag
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def scalar(self, sql):
+        self.executed.append(sql)
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+
+class StubReplica(Replica):
+
+    def __init__(self, connection):
+        super(StubReplica, self).__init__('postgresql://replica/statistic')
+        self.connection = connection
+
+    @property
+    def engine(self):
+        connection = self.connection
+        return type('Engine', (object,), {'connect': lambda self: connection})()
+
+
+class TestRoutingSession(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        self.db = RoutingSQLAlchemy(app)
+        self.db.get_replica_pool = lambda app: StubPool()
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.session = self.db.create_session({})
+        self.master = self.db.engine
+
+    def tearDown(self):
+        self.session.close()
+        self.ctx.pop()
+
+    def bind_of(self, clause):
+        return self.session.get_bind(clause=clause)
+
+    def test_selects_go_to_a_replica(self):
+        self.assertIs(self.bind_of(select([items])), REPLICA)
+
+    def test_writes_pin_to_master(self):
+        self.assertIs(self.bind_of(items.update().values(id=1)), self.master)
+        # reads after a write see it
+        self.assertIs(self.bind_of(select([items])), self.master)
+
+    def test_flush_pins_to_master(self):
+        self.session._flushing = True
+        self.assertIs(self.bind_of(select([items])), self.master)
+        self.session._flushing = False
+        self.assertIs(self.bind_of(select([items])), self.master)
+
+    def test_using_master(self):
+        with self.session.using_master():
+            self.assertIs(self.bind_of(select([items])), self.master)
+        self.assertIs(self.bind_of(select([items])), REPLICA)
+
+    def test_transaction_end_resets(self):
+        self.bind_of(items.delete())
+        self.session.rollback()
+        self.assertIs(self.bind_of(select([items])), REPLICA)
+
+    def test_no_replicas(self):
+        self.session.replicas = None
+        self.assertIs(self.bind_of(select([items])), self.master)
+
+
+class TestReplica(unittest.TestCase):
+
+    def test_lag_sql_by_version(self):
+        for version, sql in (((9, 6, 3), Replica.LAG_SQL_9), ((10, 4), Replica.LAG_SQL), ((12,), Replica.LAG_SQL)):
+            connection = StubConnection(version, 0)
+            self.assertTrue(StubReplica(connection).check(max_lag=30))
+            self.assertEqual(connection.executed, [sql])
+
+    def test_health(self):
+        self.assertFalse(StubReplica(StubConnection((10,), 0)).healthy)
+        self.assertFalse(StubReplica(StubConnection((10,), 60)).check(max_lag=30))
+        self.assertFalse(StubReplica(StubConnection((10,), RuntimeError('down'))).check(max_lag=30))
+
+    def test_pool_skips_unhealthy(self):
+        pool = ReplicaPool([])
+        healthy = StubReplica(StubConnection((10,), 0))
+        lagging = StubReplica(StubConnection((10,), 60))
+        pool.replicas = [healthy, lagging]
+        pool._ensure_checker = lambda: None
+        pool.check()
+        for _ in range(10):
+            self.assertIs(pool.choose().connect(), healthy.connection)
+        lagging.connection.lag = healthy.connection.lag = RuntimeError('down')
+        pool.check()
+        self.assertIsNone(pool.choose())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# statistic/tests/test_stat.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from statistic.server.util import stat
+
+
+def fake_fetch(dburi, sql):
+    delay, rows = dburi
+    time.sleep(delay)
+    if isinstance(rows, Exception):
+        raise rows
+    return rows
+
+
+class TestMultiDBQuery(unittest.TestCase):
+
+    def test_queries_databases_concurrently(self):
+        # Ensure wall-clock time is that of the slowest database.
+        dburis = [(0.2, [1]), (0.2, [2]), (0.2, [3]), (0.2, [4])]
+        with mock.patch.object(stat, 'fetchResultFromDB', fake_fetch):
+            started = time.time()
+            result = stat.getResultFromMultiDB(dburis, 'select 1')
+            elapsed = time.time() - started
+        self.assertEqual(sorted(result), [1, 2, 3, 4])
+        self.assertLess(elapsed, 0.6)
+
+    def test_failure_raises_with_partial_result(self):
+        dburis = [(0, [1, 2]), (0, ValueError('boom'))]
+        with mock.patch.object(stat, 'fetchResultFromDB', fake_fetch):
+            with self.assertRaises(stat.ShardQueryError) as cm:
+                stat.getResultFromMultiDB(dburis, 'select 1')
+        self.assertEqual(cm.exception.partial_result, [1, 2])
+        self.assertEqual(len(cm.exception.errors), 1)
+
+    def test_skip_policy_drops_failed_and_slow_databases(self):
+        dburis = [(0, [1]), (0, ValueError('boom')), (1, [3])]
+        with mock.patch.object(stat, 'fetchResultFromDB', fake_fetch):
+            result = stat.getResultFromMultiDB(dburis, 'select 1', timeout=0.3, on_error=stat.ON_ERROR_SKIP)
+        self.assertEqual(result, [1])
+
+
+class TestGetEngine(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            mock.patch.dict(stat._engines, clear=True),
+            mock.patch.object(stat, '_engines_pid', None),
+            mock.patch.object(stat, 'create_engine', side_effect=lambda *args, **kwargs: mock.Mock()),
+            mock.patch.object(stat, '_install_pool_guards'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_engine_is_reused_per_uri(self):
+        engine = stat.getEngine('postgres://a/db')
+        self.assertIs(stat.getEngine('postgres://a/db'), engine)
+        self.assertIsNot(stat.getEngine('postgres://b/db'), engine)
+        self.assertEqual(stat.create_engine.call_count, 2)
+
+    def test_registry_is_dropped_after_fork(self):
+        engine = stat.getEngine('postgres://a/db')
+        with mock.patch.object(stat.os, 'getpid', return_value=os.getpid() + 1):
+            child_engine = stat.getEngine('postgres://a/db')
+        self.assertIsNot(child_engine, engine)
+        # the parent's engine is forgotten, not disposed
+        self.assertFalse(engine.dispose.called)
+
+    def test_dispose_at_exit(self):
+        engine = stat.getEngine('postgres://a/db')
+        stat.disposeEngines()
+        engine.dispose.assert_called_once_with()
+        self.assertIsNot(stat.getEngine('postgres://a/db'), engine)
+
+    def test_forgotten_in_forked_child(self):
+        engine = stat.getEngine('postgres://a/db')
+        with mock.patch.object(stat, '_engines_lock'):
+            stat._forget_engines()
+            self.assertIsNot(stat.getEngine('postgres://a/db'), engine)
+        self.assertFalse(engine.dispose.called)
+
+
+class TestIterResultFromDB(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.execution_options.return_value = self.connection
+        self.result = self.connection.execute.return_value
+        self.result.fetchmany.side_effect = [[1, 2], [3, 4], [5], []]
+        engine = mock.Mock()
+        engine.connect.return_value = self.connection
+        patcher = mock.patch.object(stat, 'getEngine', return_value=engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_streams_in_batches(self):
+        self.assertEqual(list(stat.iterResultFromDB('postgres://a/db', 'select 1', fetch_size=2)), [1, 2, 3, 4, 5])
+        self.connection.execution_options.assert_called_once_with(stream_results=True)
+        self.result.fetchmany.assert_called_with(2)
+        self.connection.close.assert_called_once_with()
+
+    def test_connection_closed_when_consumer_stops_early(self):
+        rows = stat.iterResultFromDB('postgres://a/db', 'select 1', fetch_size=2)
+        self.assertEqual(next(rows), 1)
+        self.assertFalse(self.connection.close.called)
+        rows.close()
+        self.connection.close.assert_called_once_with()
+        self.assertEqual(self.result.fetchmany.call_count, 1)
+
+
+class TestWriteToFile(unittest.TestCase):
+
+    headers = ['channel', 'num']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rows_are_quoted_and_escaped(self):
+        filename = os.path.join(self.tmpdir, 'out.csv')
+        data = iter([{'channel': 'a "b", c', 'num': 1}, {'channel': '渠道', 'num': 2}])
+        stat.writeToFile(filename, data, self.headers, batch_size=1)
+        with open(filename, encoding='utf-8') as f:
+            self.assertEqual(f.read(), '"channel","num"\n"a ""b"", c","1"\n"渠道","2"\n')
+
+    def test_gzip_output(self):
+        filename = os.path.join(self.tmpdir, 'out.csv.gz')
+        stat.writeToFile(filename, ({'channel': 'c%d' % i, 'num': i} for i in range(3)), self.headers)
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+    def test_header_only_for_empty_data(self):
+        self.assertEqual(list(stat.iterCSV([], self.headers)), ['"channel","num"\n'])
+
+    def test_bad_batch_size(self):
+        for batch_size in (0, -1):
+            self.assertRaises(ValueError, list, stat.iterCSV([{'channel': 'a', 'num': 1}], self.headers, batch_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
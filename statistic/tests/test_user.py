@@ -3,12 +3,17 @@
 
 import datetime
 import unittest
+from unittest import mock
 
 from flask.ext.login import current_user
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 
 from statistic.tests.base import BaseTestCase
 import werkzeug.security as bcrypt
-from statistic.server.models import User
+from statistic.server.admin import views
+from statistic.server.models import db, User
+from statistic.server.runner import load_user
 from statistic.server.user.forms import LoginForm
 
 # skip user test
@@ -68,5 +73,67 @@ class TestUserBlueprint(object):
         self.assertIn(b'Invalid email and/or password.', response.data)
 
 
+class TestCachedUserLoader(BaseTestCase):
+
+    def setUp(self):
+        try:
+            db.create_all()
+        except OperationalError:
+            self.skipTest('database is not reachable')
+        # keep the admin view's commits in the transaction tearDown rolls back
+        for patcher in (mock.patch.object(db.session, 'commit', db.session.flush),
+                        mock.patch.object(views.login, 'current_user', mock.Mock(id=0))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        User.CACHE.clear()
+        self.addCleanup(User.CACHE.clear)
+
+        user = User('cached@user.com', 'secret', is_admin=True)
+        db.session.add(user)
+        db.session.flush()
+        self.uid, self.cache_key = user.id, user.cache_key
+        db.session.expunge_all()
+        self.view = views.UsersView(User, db.session)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def selects(self, fn):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        return [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+
+    def test_loader_hits_cache(self):
+        self.assertEqual(load_user(str(self.uid)).email, 'cached@user.com')
+        self.assertIsNotNone(User.CACHE.get(self.cache_key))
+        db.session.expunge_all()
+        self.assertEqual(self.selects(lambda: load_user(str(self.uid))), [])
+        self.assertTrue(load_user(str(self.uid)).is_admin)
+
+    def test_admin_edit_evicts(self):
+        user = load_user(str(self.uid))
+        form = mock.Mock()
+        form.populate_obj.side_effect = lambda obj: setattr(obj, 'is_admin', False)
+        self.assertTrue(self.view.update_model(form, user))
+        self.assertIsNone(User.CACHE.get(self.cache_key))
+        db.session.expunge_all()
+        self.assertFalse(load_user(str(self.uid)).is_admin)
+
+    def test_admin_delete_evicts(self):
+        user = load_user(str(self.uid))
+        self.assertTrue(self.view.delete_model(user))
+        self.assertIsNone(User.CACHE.get(self.cache_key))
+        db.session.expunge_all()
+        self.assertIsNone(load_user(str(self.uid)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+# statistic/tests/test_util.py
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unicodedata
+import unittest
+from unittest import mock
+
+from statistic.server import util
+
+
+class TestPunctuationTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.table_dir = os.path.join(self.tmpdir, 'table')
+        patcher = mock.patch.object(util, 'PUNCTUATION_TABLE_DIR', self.table_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def table_path(self):
+        return os.path.join(self.table_dir, 'statistic-punctuation-%s-%s.json' % (
+            unicodedata.unidata_version, sys.maxunicode))
+
+    def write_table(self, codepoints, mode):
+        with open(self.table_path(), 'w') as f:
+            json.dump(codepoints, f)
+        os.chmod(self.table_path(), mode)
+
+    def test_saved_in_private_dir(self):
+        table = util._load_none_character_table()
+        self.assertIn(ord('!'), table)
+        self.assertEqual(os.stat(self.table_dir).st_mode & 0o777, 0o700)
+        self.assertTrue(os.path.exists(self.table_path()))
+        self.assertEqual(util._load_none_character_table(), table)
+
+    def test_shared_dir_is_not_used(self):
+        os.mkdir(self.table_dir)
+        os.chmod(self.table_dir, 0o777)
+        self.write_table([ord('a')], 0o600)
+        table = util._load_none_character_table()
+        self.assertIn(ord('!'), table)
+        self.assertNotIn(ord('a'), table)
+
+    def test_writable_table_is_rebuilt(self):
+        os.mkdir(self.table_dir, 0o700)
+        self.write_table([ord('a')], 0o666)
+        table = util._load_none_character_table()
+        self.assertIn(ord('!'), table)
+        self.assertNotIn(ord('a'), table)
+
+
+if __name__ == '__main__':
+    unittest.main()